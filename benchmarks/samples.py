@@ -0,0 +1,52 @@
+"""
+Compare how samples are checked now with how they used to be.
+
+Waffle used to read each sample from the cache on every check, test the
+current site against the sample's sites and roll a ``Decimal`` built from
+a string. It now reads a table of integer thresholds for the whole site
+once, and rolls a per-thread generator against the threshold. This prints
+how long one check takes each way, with the cache read left out of both.
+
+Run it from the root of the repository:
+
+    ./run.sh bench
+"""
+from __future__ import print_function, unicode_literals
+
+from decimal import Decimal
+import random
+import timeit
+
+import django
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+from waffle import _probe  # noqa
+from waffle.rules import percent_threshold  # noqa
+
+
+NUMBER = 200000
+PERCENT = Decimal('12.5')
+SITE_ID = 1
+
+
+def old_check(sample_percent=PERCENT, site_ids=frozenset([SITE_ID])):
+    return (SITE_ID in site_ids and
+            Decimal(str(random.uniform(0, 100))) <= sample_percent)
+
+
+def new_check(table={'mysample': percent_threshold(PERCENT)}):
+    threshold = table.get('mysample')
+    return threshold is not None and _probe(threshold)
+
+
+def main():
+    print('%8s  %12s' % ('check', 'time (ns)'))
+    for label, check in (('decimal', old_check), ('table', new_check)):
+        seconds = timeit.timeit(check, number=NUMBER) / NUMBER
+        print('%8s  %12.0f' % (label, seconds * 1e9))
+
+
+if __name__ == '__main__':
+    main()
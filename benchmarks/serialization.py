@@ -0,0 +1,68 @@
+"""
+Compare how flags are stored in the cache now with how they used to be.
+
+Waffle used to cache the Flag model instance itself, and the users and
+groups of each flag as lists of model instances. It now caches a compiled
+FlagRule holding sorted arrays of ids. This prints the pickled size of both,
+and how long each takes to unpickle, for flags with 0, 100 and 100,000
+targeted users.
+
+Run it from the root of the repository:
+
+    ./run.sh bench
+"""
+from __future__ import print_function, unicode_literals
+
+import pickle
+import timeit
+
+import django
+from django.contrib.auth.models import Group, User
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+from waffle.models import Flag  # noqa
+from waffle.rules import FlagRule, IdSet  # noqa
+
+
+USER_COUNTS = (0, 100, 100000)
+
+
+def old_format(users):
+    flag = Flag(pk=1, name='myflag', percent='12.5', languages='en,fr',
+                note='Rolls out the new checkout. Owner: payments team.')
+    user_objs = [User(pk=pk, username='user%d' % pk) for pk in users]
+    group_objs = [Group(pk=1, name='beta')]
+    return (flag, user_objs, group_objs)
+
+
+def new_format(users):
+    user_ids = IdSet(users)
+    rule = FlagRule(1, 'myflag', percent=125, languages=['en', 'fr'],
+                    has_users=bool(user_ids), has_groups=True,
+                    user_ids=user_ids, group_ids=[1])
+    return (rule,)
+
+
+def measure(entries, number):
+    data = [pickle.dumps(e, pickle.HIGHEST_PROTOCOL) for e in entries]
+    size = sum(len(d) for d in data)
+    seconds = timeit.timeit(lambda: [pickle.loads(d) for d in data],
+                            number=number) / number
+    return size, seconds
+
+
+def main():
+    print('%8s  %8s  %12s  %12s' % ('users', 'format', 'bytes', 'decode (us)'))
+    for count in USER_COUNTS:
+        users = range(1, count + 1)
+        number = 10 if count > 1000 else 2000
+        for label, build in (('pickle', old_format), ('compact', new_format)):
+            size, seconds = measure(build(users), number)
+            print('%8d  %8s  %12d  %12.1f' % (count, label, size,
+                                              seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
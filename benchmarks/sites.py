@@ -0,0 +1,92 @@
+"""
+Compare the old and new queries for the flags that apply to a site.
+
+The ``get_*_for_site`` helpers used to join the site through table and make
+the rows distinct; they now use a semi-join on it instead. This creates a
+throwaway database with 50,000 flags and 1,000 sites (a tenth of the flags
+on all sites, the rest on one site each), checks both queries return the
+same flags, and prints how long each takes and how the database plans it.
+
+Run it from the root of the repository:
+
+    ./run.sh bench
+"""
+from __future__ import print_function, unicode_literals
+
+import timeit
+
+import django
+from django.db import connection
+from django.db.models import Q
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.contrib.sites.models import Site  # noqa
+from django.test.utils import setup_test_environment  # noqa
+
+from waffle.models import Flag  # noqa
+
+
+FLAGS = 50000
+SITES = 1000
+NUMBER = 20
+
+
+def old_query(site):
+    return Flag.objects.filter(
+        Q(site=site) | Q(all_sites_override=True)).distinct()
+
+
+def new_query(site):
+    return Flag.get_flags_for_site(site)
+
+
+def populate():
+    Site.objects.bulk_create(
+        [Site(pk=pk, domain='site%d.example.com' % pk, name='site%d' % pk)
+         for pk in range(2, SITES + 1)])
+    Flag.objects.bulk_create(
+        [Flag(pk=pk, name='flag%d' % pk, all_sites_override=pk % 10 == 0)
+         for pk in range(1, FLAGS + 1)])
+    Flag.site.through.objects.bulk_create(
+        [Flag.site.through(flag_id=pk, site_id=pk % SITES + 1)
+         for pk in range(1, FLAGS + 1) if pk % 10 != 0])
+
+
+def plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    else:
+        explain = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(explain + sql, params)
+    return [' '.join(str(c) for c in row) for row in cursor.fetchall()]
+
+
+def main():
+    setup_test_environment()
+    name = connection.creation.create_test_db(verbosity=0)
+    try:
+        populate()
+        site = Site.objects.get(pk=SITES // 2)
+        old = sorted(old_query(site).values_list('pk', flat=True))
+        new = sorted(new_query(site).values_list('pk', flat=True))
+        assert old == new, 'the queries disagree'
+        print('%d flags on site %d' % (len(new), site.pk))
+        for label, query in (('join', old_query), ('semi-join', new_query)):
+            # Just the ids, so building model instances doesn't drown out
+            # the query itself.
+            seconds = timeit.timeit(
+                lambda: list(query(site).values_list('pk', flat=True)),
+                number=NUMBER) / NUMBER
+            print('\n%s: %.1f ms' % (label, seconds * 1e3))
+            for line in plan(query(site)):
+                print('    ' + line)
+    finally:
+        connection.creation.destroy_test_db(name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ export DJANGO_SETTINGS_MODULE="test_settings"
 usage() {
     echo "USAGE: $0 [command]"
     echo "  test - run the waffle tests"
+    echo "  bench - run the benchmarks"
     echo "  shell - open the Django shell"
     echo "  schema - create a schema migration for any model changes"
     exit 1
@@ -14,6 +15,8 @@ usage() {
 case "$1" in
     "test" )
         django-admin.py test waffle ;;
+    "bench" )
+        for b in benchmarks/*.py; do python "$b"; done ;;
     "lint" )
         flake8 waffle ;;
     "shell" )
@@ -1,7 +1,8 @@
-from decimal import Decimal
 import random
+import threading
 
-from waffle.utils import get_setting, keyfmt
+from waffle.rules import SampleRule, percent_threshold
+from waffle.utils import bucket, get_setting
 from django.contrib.sites.models import Site
 
 
@@ -9,28 +10,195 @@ VERSION = (0, 10, 1)
 __version__ = '.'.join(map(str, VERSION))
 
 
+def _request_memo(request, kind):
+    """Return the per-request evaluation cache for ``kind``.
+
+    Results are stored on the request so that repeated checks of the same
+    name during one request don't go back to the cache or the database.
+    Returns ``None`` when there is no request to store them on.
+    """
+    if request is None:
+        return None
+    try:
+        memo = request._waffle_memo
+    except AttributeError:
+        memo = request._waffle_memo = {'flags': {}, 'switches': {},
+                                       'samples': {}, 'sample_tables': {}}
+    return memo[kind]
+
+
+def _get_user_group_ids(user):
+    """Return the ids of the groups ``user`` is in.
+
+    They're loaded once and kept on the user object, which lives as long as
+    the request does. Changing the user's groups clears them again (see
+    ``waffle.models.uncache_user_groups``).
+    """
+    from .models import connect_user_groups
+
+    try:
+        return user._waffle_group_ids
+    except AttributeError:
+        pass
+    connect_user_groups()
+    if user.pk is None:
+        group_ids = frozenset()
+    else:
+        group_ids = frozenset(user.groups.values_list('pk', flat=True))
+    user._waffle_group_ids = group_ids
+    return group_ids
+
+
+def _get_snapshot(site):
+    """Return the snapshot of ``site`` if waffle keeps one in-process.
+
+    With ``WAFFLE_LOCAL_CACHE_TIMEOUT`` set, the whole site is loaded at
+    once and every check is answered from memory. Otherwise checks look
+    things up in the cache one by one.
+    """
+    from .compat import cache
+    from .local import LocalCache
+    if isinstance(cache, LocalCache):
+        from .models import get_snapshot
+        return get_snapshot(site)
+    return None
+
+
+def _bucketing_key(request):
+    """Return a stable key for the subject of ``request``, or ``None``.
+
+    This is ``WAFFLE_BUCKETING_ATTRIBUTE`` (a dotted path of attributes or
+    keys on the request) if set, else the user id for authenticated users,
+    else the session key.
+    """
+    attribute = get_setting('BUCKETING_ATTRIBUTE')
+    if attribute:
+        key = request
+        for part in attribute.split('.'):
+            try:
+                key = getattr(key, part)
+            except AttributeError:
+                try:
+                    key = key[part]
+                except (KeyError, TypeError):
+                    return None
+        return key
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return user.pk
+    session = getattr(request, 'session', None)
+    if session is not None:
+        return session.session_key
+    return None
+
+
 def set_flag(request, flag_name, active=True, session_only=False):
     """Set a flag value on a request object."""
     if not hasattr(request, 'waffles'):
         request.waffles = {}
     request.waffles[flag_name] = [active, session_only]
+    _request_memo(request, 'flags').pop(flag_name, None)
 
 
-def flag_is_active(request, flag_name):
-    from .models import cache_flag, Flag
-    from .compat import cache
+def _flag_memo_hit(memo, flag_name, site_id, user, language):
+    # The decision depends on the user and language too, so only reuse it
+    # while those haven't been swapped out on the request.
+    hit = memo.get(flag_name) if memo is not None else None
+    if (hit is not None and hit[0] == site_id and
+            hit[1] is user and hit[2] == language):
+        return hit
+    return None
 
+
+def flag_is_active(request, flag_name):
     current_site = Site.objects.get_current(request)
-    flag = cache.get(keyfmt(get_setting('FLAG_CACHE_KEY'),
-                            flag_name, current_site))
+    user = getattr(request, 'user', None)
+    language = getattr(request, 'LANGUAGE_CODE', None)
+
+    memo = _request_memo(request, 'flags')
+    hit = _flag_memo_hit(memo, flag_name, current_site.id, user, language)
+    if hit is not None:
+        return hit[3]
+
+    active = _flag_is_active(request, flag_name, current_site)
+    if memo is not None:
+        memo[flag_name] = (current_site.id, user, language, active)
+    return active
+
 
-    if flag is None:
-        flag = Flag.objects.filter(name=flag_name).first()
-        if flag is None:
-            return get_setting("FLAG_DEFAULT")
-        cache_flag(instance=flag)
+def flags_are_active(request, flag_names):
+    """Check several flags at once.
 
-    if current_site not in flag.get_sites():
+    Returns a dict mapping each name to whether the flag is active. All the
+    flags not already checked during this request are fetched from the cache
+    in a fixed number of round trips, and any that aren't cached from the
+    database in a fixed number of queries.
+    """
+    from .models import FLAG_KEYS, fetch_cached, load_flags
+
+    current_site = Site.objects.get_current(request)
+    user = getattr(request, 'user', None)
+    language = getattr(request, 'LANGUAGE_CODE', None)
+    memo = _request_memo(request, 'flags')
+
+    results = {}
+    todo = []
+    for name in flag_names:
+        hit = _flag_memo_hit(memo, name, current_site.id, user, language)
+        if hit is not None:
+            results[name] = hit[3]
+        elif name not in todo:
+            todo.append(name)
+    if not todo:
+        return results
+
+    snapshot = _get_snapshot(current_site)
+    if snapshot is not None:
+        found = dict((name, snapshot.flags.get(name)) for name in todo)
+    else:
+        found = fetch_cached(todo, FLAG_KEYS, current_site, load_flags)
+
+    for name in todo:
+        entries = found[name]
+        if entries is None:
+            active = get_setting('FLAG_DEFAULT')
+        else:
+            active = _check_flag(request, entries[0], current_site,
+                                 entries[1])
+        if memo is not None:
+            memo[name] = (current_site.id, user, language, active)
+        results[name] = active
+    return results
+
+
+def _flag_is_active(request, flag_name, current_site):
+    from .models import FLAG_KEYS, fetch_cached, load_flags
+
+    snapshot = _get_snapshot(current_site)
+    if snapshot is not None:
+        entries = snapshot.flags.get(flag_name)
+    else:
+        entries = fetch_cached([flag_name], FLAG_KEYS, current_site,
+                               load_flags)[flag_name]
+    if entries is None:
+        return get_setting('FLAG_DEFAULT')
+    flag, flag_users = entries
+    return _check_flag(request, flag, current_site, flag_users)
+
+
+def _check_flag(request, flag, current_site, flag_users=None):
+    """Decide whether the compiled ``flag`` is active for ``request``.
+
+    The users and groups of the flag are normally part of the rule.
+    ``flag_users`` are the users of a flag with too many to inline; they're
+    loaded from the database if they're needed and weren't passed in (or
+    have been evicted), as are the id sets of rules built without them.
+    """
+    from .models import get_flag_group_ids, get_flag_user_ids
+
+    flag_name = flag.name
+
+    if not flag.on_site(current_site):
         return False
 
     if get_setting('OVERRIDE'):
@@ -65,42 +233,45 @@ def flag_is_active(request, flag_name):
         return True
 
     if flag.languages:
-        languages = flag.languages.split(',')
-        if (hasattr(request, 'LANGUAGE_CODE') and
-                request.LANGUAGE_CODE in languages):
+        if getattr(request, 'LANGUAGE_CODE', None) in flag.languages:
             return True
 
-    flag_users = cache.get(keyfmt(get_setting('FLAG_USERS_CACHE_KEY'),
-                                              flag.name, current_site))
-    if flag_users is None:
-        flag_users = flag.users.all()
-        cache_flag(instance=flag)
-    if user in flag_users:
-        return True
+    if flag.has_users:
+        if flag.user_ids is not None:
+            flag_users = flag.user_ids
+        elif flag_users is None:
+            flag_users = get_flag_user_ids(flag.pk)
+        if user.pk in flag_users:
+            return True
 
-    flag_groups = cache.get(keyfmt(get_setting('FLAG_GROUPS_CACHE_KEY'),
-                                   flag.name, current_site))
-    if flag_groups is None:
-        flag_groups = flag.groups.all()
-        cache_flag(instance=flag)
-    user_groups = user.groups.all()
-    for group in flag_groups:
-        if group in user_groups:
+    if flag.has_groups:
+        flag_groups = flag.group_ids
+        if flag_groups is None:
+            flag_groups = get_flag_group_ids(flag.pk)
+        if not flag_groups.isdisjoint(_get_user_group_ids(user)):
             return True
 
-    if flag.percent and flag.percent > 0:
+    if flag.percent > 0:
         if not hasattr(request, 'waffles'):
             request.waffles = {}
         elif flag_name in request.waffles:
             return request.waffles[flag_name][0]
 
+        # In bucketing mode the same subject always lands in the same
+        # bucket, so there's no need for a cookie to keep it sticky.
+        if get_setting('FLAG_BUCKETING'):
+            key = _bucketing_key(request)
+            if key is not None:
+                return bucket(flag_name, key) < flag.percent
+
         cookie = get_setting('COOKIE') % flag_name
         if cookie in request.COOKIES:
             flag_active = (request.COOKIES[cookie] == 'True')
             set_flag(request, flag_name, flag_active, flag.rollout)
             return flag_active
 
-        if Decimal(str(random.uniform(0, 100))) <= flag.percent:
+        # flag.percent is in tenths of a percent.
+        if random.uniform(0, 100) * 10 <= flag.percent:
             set_flag(request, flag_name, True, flag.rollout)
             return True
         set_flag(request, flag_name, False, flag.rollout)
@@ -109,38 +280,135 @@ def flag_is_active(request, flag_name):
 
 
 def switch_is_active(request, switch_name):
-    from .models import cache_switch, Switch
-    from .compat import cache
+    current_site = Site.objects.get_current(request)
+    active = _get_switch_table(request, current_site).get(switch_name)
+    if active is None:
+        return get_setting('SWITCH_DEFAULT')
+    return active
+
 
+def switches_are_active(request, switch_names):
+    """Check several switches at once, like :func:`flags_are_active`."""
     current_site = Site.objects.get_current(request)
-    switch = cache.get(keyfmt(get_setting('SWITCH_CACHE_KEY'),
-                              switch_name, current_site))
-    if switch is None:
-        switch = Switch.objects.filter(name=switch_name).first()
-        if switch is None:
-            return get_setting('SWITCH_DEFAULT')
+    table = _get_switch_table(request, current_site)
+    default = get_setting('SWITCH_DEFAULT')
+    return dict((name, table.get(name, default)) for name in switch_names)
 
-        cache_switch(instance=switch)
 
-    return switch.active and current_site in switch.get_sites()
+def _get_switch_table(request, current_site):
+    """Return whether each switch on ``current_site`` is active, by name.
 
+    The whole table is fetched at once and kept for the rest of the
+    request, so checking any number of switches costs one fetch.
+    """
+    from .models import get_switch_table
 
-def probe_a_sample(sample):
-    return Decimal(str(random.uniform(0, 100))) <= sample.percent
+    memo = _request_memo(request, 'switches')
+    table = memo.get(current_site.id) if memo is not None else None
+    if table is None:
+        table = get_switch_table(current_site)
+        if memo is not None:
+            memo[current_site.id] = table
+    return table
 
 
-def sample_is_active(request, sample_name):
-    from .models import cache_sample, Sample
-    from .compat import cache
+_local = threading.local()
+
 
+def _random():
+    """Return ``random()`` of this thread's own generator.
+
+    Threads don't share the module's generator, or its lock.
+    """
+    try:
+        return _local.random
+    except AttributeError:
+        _local.random = random.Random().random
+        return _local.random
+
+
+def _probe(threshold):
+    """Roll against ``threshold``, in tenths of a percent."""
+    return _random()() * 1000 < threshold
+
+
+def _sample_threshold(sample):
+    """The threshold of ``sample``, converted once per percentage."""
+    if isinstance(sample, SampleRule):
+        return sample.percent
+    percent = sample.percent
+    cached = getattr(sample, '_waffle_threshold', None)
+    if cached is None or cached[0] != percent:
+        cached = sample._waffle_threshold = (percent,
+                                             percent_threshold(percent))
+    return cached[1]
+
+
+def probe_a_sample(sample, key=None):
+    """Roll once against ``sample``.
+
+    ``sample`` is a :class:`~waffle.models.Sample`, or a
+    :class:`~waffle.rules.SampleRule` compiled from one ahead of a lot of
+    rolls. With a ``key``, the roll is :func:`~waffle.utils.bucket` of the
+    sample name and the key, so it's the same every time.
+    """
+    threshold = _sample_threshold(sample)
+    if key is not None:
+        return bucket(sample.name, key) < threshold
+    return _probe(threshold)
+
+
+def sample_is_active(request, sample_name, key=None):
+    """Whether the sample called ``sample_name`` is active.
+
+    Without a ``key`` this is random, but sticky for the rest of the
+    request. With one, the sample name and ``key`` (a trace or request id,
+    say) are hashed into a stable bucket, so every check with the same key
+    anywhere gets the same answer.
+    """
     current_site = Site.objects.get_current(request)
-    sample = cache.get(keyfmt(get_setting('SAMPLE_CACHE_KEY'),
-                              sample_name, current_site))
-    if sample is None:
-        sample = Sample.objects.filter(name=sample_name).first()
-        if sample is None:
-            return get_setting('SAMPLE_DEFAULT')
 
-        cache_sample(instance=sample)
+    if key is not None:
+        return _sample_is_active(request, sample_name, current_site, key)
+
+    # Samples are sticky for the duration of a request.
+    memo = _request_memo(request, 'samples')
+    hit = memo.get(sample_name) if memo is not None else None
+    if hit is not None and hit[0] == current_site.id:
+        return hit[1]
+
+    active = _sample_is_active(request, sample_name, current_site)
+    if memo is not None:
+        memo[sample_name] = (current_site.id, active)
+    return active
+
+
+def samples_are_active(request, sample_names, key=None):
+    """Check several samples at once, like :func:`flags_are_active`."""
+    return dict((name, sample_is_active(request, name, key))
+                for name in sample_names)
+
+
+def _sample_is_active(request, sample_name, current_site, key=None):
+    threshold = _get_sample_table(request, current_site).get(sample_name)
+    if threshold is None:
+        return get_setting('SAMPLE_DEFAULT')
+    if key is not None:
+        return bucket(sample_name, key) < threshold
+    return _probe(threshold)
+
+
+def _get_sample_table(request, current_site):
+    """Return the threshold of each sample on ``current_site``, by name.
+
+    Like the switch table, it's fetched once per request.
+    """
+    from .models import get_sample_table
 
-    return probe_a_sample(sample) and current_site in sample.get_sites()
+    memo = _request_memo(request, 'sample_tables')
+    table = memo.get(current_site.id) if memo is not None else None
+    if table is None:
+        table = get_sample_table(current_site)
+        if memo is not None:
+            memo[current_site.id] = table
+    return table
@@ -14,4 +14,8 @@ if hasattr(settings, 'WAFFLE_CACHE_NAME'):
 else:
     from django.core.cache import cache
 
+if getattr(settings, 'WAFFLE_LOCAL_CACHE_TIMEOUT', None):
+    from waffle.local import LocalCache
+    cache = LocalCache(cache, settings.WAFFLE_LOCAL_CACHE_TIMEOUT)
+
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
@@ -9,15 +9,31 @@ MAX_AGE = 2592000  # 1 month in seconds
 CACHE_PREFIX = 'waffle:'
 FLAG_CACHE_KEY = 'flag:%s'
 FLAG_USERS_CACHE_KEY = 'flag:%s:users'
-FLAG_GROUPS_CACHE_KEY = 'flag:%s:groups'
 ALL_FLAGS_CACHE_KEY = 'flags:all'
-SAMPLE_CACHE_KEY = 'sample:%s'
 ALL_SAMPLES_CACHE_KEY = 'samples:all'
-SWITCH_CACHE_KEY = 'switch:%s'
+SAMPLE_TABLE_CACHE_KEY = 'sample-table:%s'
 ALL_SWITCHES_CACHE_KEY = 'switches:all'
+SWITCH_TABLE_CACHE_KEY = 'switch-table:%s'
+GENERATION_CACHE_KEY = 'generation'
+VERSION_CACHE_KEY = 'version:%s'
+SNAPSHOT_CACHE_KEY = 'snapshot:%s'
+ABSENT_CACHE_TIMEOUT = 60
+LOCK_CACHE_KEY = 'lock:%s'
+CACHE_LOCK_TIMEOUT = 5
+STALE_CACHE_KEY = 'stale:%s'
+STALE_CACHE_TIMEOUT = 86400
+CACHE_EARLY_REFRESH = 0
+WRITE_THROUGH = False
+CACHE_KEY_HASH = 'md5'
+KEY_CACHE_SIZE = 4096
+FLAG_INLINE_USERS = 10000
+SITE_REGISTRY_SIZE = 10000
 
 FLAG_DEFAULT = False
 SAMPLE_DEFAULT = False
 SWITCH_DEFAULT = False
 
 OVERRIDE = False
+
+FLAG_BUCKETING = False
+BUCKETING_ATTRIBUTE = None
@@ -0,0 +1,164 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from waffle.utils import get_setting, keyfmt
+
+
+__all__ = ['LocalCache', 'bump', 'bump_generation', 'get_generation',
+           'get_versions']
+
+
+class LocalCache(object):
+    """A process-local layer in front of a Django cache.
+
+    Everything read from or written to the wrapped cache is also kept in a
+    dict, so repeat reads are plain lookups with no network hop and nothing
+    to unpickle. At most every ``timeout`` seconds a single generation key is
+    read from the wrapped cache; when it has moved on (see
+    :func:`bump_generation`) the local copy is thrown away.
+    """
+
+    def __init__(self, cache, timeout):
+        self.cache = cache
+        self.timeout = timeout
+        self._data = {}
+        self._generation = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _generation_key(self):
+        return keyfmt(get_setting('GENERATION_CACHE_KEY'))
+
+    def _validate(self):
+        now = time.time()
+        if now - self._checked < self.timeout:
+            return
+        with self._lock:
+            if now - self._checked < self.timeout:
+                return
+            generation = self.cache.get(self._generation_key())
+            if generation != self._generation:
+                self._data = {}
+                self._generation = generation
+            self._checked = now
+
+    def invalidate(self):
+        """Drop everything held locally and revalidate on next use."""
+        with self._lock:
+            self._data = {}
+            self._checked = 0
+
+    def get(self, key, default=None, **kwargs):
+        self._validate()
+        value = self._data.get(key)
+        if value is None:
+            value = self.cache.get(key, **kwargs)
+            if value is None:
+                return default
+            self._data[key] = value
+        return value
+
+    def get_many(self, keys, **kwargs):
+        self._validate()
+        data = self._data
+        found = {}
+        missing = []
+        for key in keys:
+            value = data.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self.cache.get_many(missing, **kwargs)
+            data.update(fetched)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, *args, **kwargs):
+        self.cache.set(key, value, *args, **kwargs)
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = value
+
+    def add(self, key, value, *args, **kwargs):
+        added = self.cache.add(key, value, *args, **kwargs)
+        if added and value is not None:
+            self._data[key] = value
+        return added
+
+    def set_many(self, data, *args, **kwargs):
+        self.cache.set_many(data, *args, **kwargs)
+        self._data.update(
+            (k, v) for k, v in data.items() if v is not None)
+
+    def delete(self, key, **kwargs):
+        self.cache.delete(key, **kwargs)
+        self._data.pop(key, None)
+
+    def delete_many(self, keys, **kwargs):
+        self.cache.delete_many(keys, **kwargs)
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+        self.invalidate()
+
+    def __getattr__(self, name):
+        # Anything else (incr, decr, close, ...) goes straight through.
+        return getattr(self.cache, name)
+
+
+def _seed():
+    # A counter that was unset or evicted starts somewhere no process has
+    # seen before, so stale entries written under an old value are never
+    # read again.
+    return int(time.time() * 1000)
+
+
+def get_versions(keys):
+    """Read the version counters at ``keys``, starting any that are unset.
+
+    Returns a dict mapping each key to its version.
+    """
+    from waffle.compat import cache
+
+    versions = cache.get_many(keys)
+    missing = [k for k in keys if versions.get(k) is None]
+    if missing:
+        for key in missing:
+            cache.add(key, _seed(), None)
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def bump(key):
+    """Move the version counter at ``key`` on, in one round trip."""
+    from waffle.compat import cache
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _seed(), None)
+
+
+def get_generation():
+    """The current generation of waffle's cache as a whole."""
+    key = keyfmt(get_setting('GENERATION_CACHE_KEY'))
+    return get_versions([key])[key]
+
+
+def bump_generation():
+    """Tell every process to drop its local copy of waffle's cache.
+
+    Processes notice within ``WAFFLE_LOCAL_CACHE_TIMEOUT`` seconds.
+    """
+    from waffle.compat import cache
+
+    bump(keyfmt(get_setting('GENERATION_CACHE_KEY')))
+    if isinstance(cache, LocalCache):
+        cache.invalidate()
@@ -7,10 +7,12 @@ class WaffleMiddleware(object):
     def process_response(self, request, response):
         secure = get_setting('SECURE')
         max_age = get_setting('MAX_AGE')
+        cookie = get_setting('COOKIE')
+        test_cookie = get_setting('TEST_COOKIE')
 
         if hasattr(request, 'waffles'):
             for k in request.waffles:
-                name = smart_str(get_setting('COOKIE') % k)
+                name = smart_str(cookie % k)
                 active, rollout = request.waffles[k]
                 if rollout and not active:
                     # "Inactive" is a session cookie during rollout mode.
@@ -21,7 +23,7 @@ class WaffleMiddleware(object):
                                     secure=secure)
         if hasattr(request, 'waffle_tests'):
             for k in request.waffle_tests:
-                name = smart_str(get_setting('TEST_COOKIE') % k)
+                name = smart_str(test_cookie % k)
                 value = request.waffle_tests[k]
                 response.set_cookie(name, value=value)
 
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waffle', '0007_new_option_all_sites_override'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='flag',
+            index_together=set([('name', 'all_sites_override')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='switch',
+            index_together=set([('name', 'all_sites_override')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sample',
+            index_together=set([('name', 'all_sites_override')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waffle', '0008_name_site_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='flag',
+            name='all_sites_override',
+            field=models.BooleanField(default=True, help_text=b"When True this flag is used for all sites IMPORTANT: don't allow to create two flags with the same name", db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='sample',
+            name='all_sites_override',
+            field=models.BooleanField(default=True, help_text=b"When True this sample is used for all sites IMPORTANT: don't allow to create two samples with the same name", db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='switch',
+            name='all_sites_override',
+            field=models.BooleanField(default=True, help_text=b"When True this switch is used for all sites IMPORTANT: don't allow to create two switches with the same name", db_index=True),
+        ),
+    ]
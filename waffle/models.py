@@ -1,33 +1,75 @@
-from django.db.models import Q
+from collections import OrderedDict, defaultdict
+import math
+import random
+import time
+
+from django.db.models import Case, Q, Value, When
 
 try:
     from django.utils import timezone as datetime
 except ImportError:
     from datetime import datetime
 
+from django.conf import settings
 from django.core import serializers
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.sites.models import Site
-from django.db import models
-from django.db.models.signals import post_save, post_delete, m2m_changed, pre_save, pre_delete
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from waffle.compat import AUTH_USER_MODEL, cache
-from waffle.utils import get_setting, keyfmt
+from waffle.local import bump, bump_generation, get_generation, get_versions
+from waffle import rules
+from waffle.rules import ABSENT, PER_SITE, FlagRule, IdSet, Snapshot
+from waffle.sites import site_registry
+from waffle.utils import build_key, get_setting, key_cache, keyfmt
+
 
+def get_all_sites():
+    """Every site, from the :data:`~waffle.sites.site_registry`."""
+    return site_registry.all()
 
-LOCAL_CACHE = {}
 
+def _get_sites(obj):
+    """The sites ``obj`` applies to, from the site registry.
+
+    This is a list, not a QuerySet, so it can't be filtered further.
+    """
+    if obj.all_sites_override:
+        return site_registry.all()
+    through = type(obj).site.through
+    field = type(obj)._meta.model_name
+    return site_registry.get_many(through.objects.filter(
+        **{field: obj}).values_list('site_id', flat=True))
 
-def get_all_sites():
-    if LOCAL_CACHE.get("all_sites") is None:
-        LOCAL_CACHE["all_sites"] = Site.objects.all()
-    return LOCAL_CACHE["all_sites"]
 
+def _for_site(model, site):
+    """The objects of ``model`` that apply to ``site``.
+
+    This is a semi-join on the site through table rather than a join, so
+    no object is repeated and there's nothing to make distinct, and both
+    halves can be answered from indexes.
+    """
+    return model.objects.filter(_on_site_q(model, site))
 
-def clear_all_site_cache(*args, **kwargs):
-    LOCAL_CACHE["all_sites"] = None
 
-pre_save.connect(clear_all_site_cache, sender=Site)
-pre_delete.connect(clear_all_site_cache, sender=Site)
+def _on_site_q(model, site):
+    through = model.site.through
+    on_site = through.objects.filter(site=site).values(
+        model._meta.model_name + '_id')
+    return Q(all_sites_override=True) | Q(pk__in=on_site)
+
+
+def _by_site(model, site):
+    """Every object of ``model``, those that apply to ``site`` first.
+
+    Among those, objects on ``site`` itself come before objects on all
+    sites. Each row is annotated with ``on_site``.
+    """
+    on_site = Case(When(_on_site_q(model, site), then=Value(True)),
+                   default=Value(False), output_field=models.BooleanField())
+    return model.objects.annotate(on_site=on_site).order_by(
+        '-on_site', 'all_sites_override', 'pk')
 
 
 class FlagQuerySet(models.QuerySet):
@@ -81,9 +123,11 @@ class Flag(models.Model):
     modified = models.DateTimeField(default=datetime.now, help_text=(
         'Date when this Flag was last modified.'))
 
-    all_sites_override = models.BooleanField(default=True, help_text=(
-        'When True this flag is used for all sites'
-        ' IMPORTANT: don\'t allow to create two flags with the same name'))
+    all_sites_override = models.BooleanField(
+        default=True, db_index=True, help_text=(
+            'When True this flag is used for all sites'
+            ' IMPORTANT: don\'t allow to create two flags with the'
+            ' same name'))
 
     site = models.ManyToManyField(Site, blank=True,
                                   related_name="waffle_flags_m2m",
@@ -93,13 +137,10 @@ class Flag(models.Model):
 
     @staticmethod
     def get_flags_for_site(site):
-        return Flag.objects.filter(Q(site=site) | Q(all_sites_override=True)).distinct()
+        return _for_site(Flag, site)
 
     def get_sites(self):
-        if not self.all_sites_override:
-            return self.site.all()
-        else:
-            return get_all_sites()
+        return _get_sites(self)
 
     def get_sites_json(self):
         return serializers.serialize("json", self.get_sites())
@@ -111,6 +152,10 @@ class Flag(models.Model):
         self.modified = datetime.now()
         super(Flag, self).save(*args, **kwargs)
 
+    class Meta:
+        # Names are looked up by site; see _resolve.
+        index_together = [('name', 'all_sites_override')]
+
 
 class SwitchQuerySet(models.QuerySet):
     def create(self, **kwargs):
@@ -142,9 +187,11 @@ class Switch(models.Model):
     modified = models.DateTimeField(default=datetime.now, help_text=(
         'Date when this Switch was last modified.'))
 
-    all_sites_override = models.BooleanField(default=True, help_text=(
-        'When True this switch is used for all sites'
-        ' IMPORTANT: don\'t allow to create two switches with the same name'))
+    all_sites_override = models.BooleanField(
+        default=True, db_index=True, help_text=(
+            'When True this switch is used for all sites'
+            ' IMPORTANT: don\'t allow to create two switches with the'
+            ' same name'))
 
     site = models.ManyToManyField(Site, blank=True,
                                   related_name="waffle_switches_m2m",
@@ -154,13 +201,10 @@ class Switch(models.Model):
 
     @staticmethod
     def get_switches_for_site(site):
-        return Switch.objects.filter(Q(site=site) | Q(all_sites_override=True)).distinct()
+        return _for_site(Switch, site)
 
     def get_sites(self):
-        if not self.all_sites_override:
-            return self.site.all()
-        else:
-            return get_all_sites()
+        return _get_sites(self)
 
     def get_sites_json(self):
         return serializers.serialize("json", self.get_sites())
@@ -174,6 +218,8 @@ class Switch(models.Model):
 
     class Meta:
         verbose_name_plural = 'Switches'
+        # Names are looked up by site; see _resolve.
+        index_together = [('name', 'all_sites_override')]
 
 
 class SampleQuerySet(models.QuerySet):
@@ -209,21 +255,20 @@ class Sample(models.Model):
                                   related_name="waffle_samples_m2m",
                                   help_text="utilized only if `all_sites_override` is set to False")
 
-    all_sites_override = models.BooleanField(default=True, help_text=(
-        'When True this sample is used for all sites'
-        ' IMPORTANT: don\'t allow to create two samples with the same name'))
+    all_sites_override = models.BooleanField(
+        default=True, db_index=True, help_text=(
+            'When True this sample is used for all sites'
+            ' IMPORTANT: don\'t allow to create two samples with the'
+            ' same name'))
 
     objects = SampleQuerySet.as_manager()
 
     @staticmethod
     def get_samples_for_site(site):
-        return Sample.objects.filter(Q(site=site) | Q(all_sites_override=True)).distinct()
+        return _for_site(Sample, site)
 
     def get_sites(self):
-        if not self.all_sites_override:
-            return self.site.all()
-        else:
-            return get_all_sites()
+        return _get_sites(self)
 
     def get_sites_json(self):
         return serializers.serialize("json", self.get_sites())
@@ -235,38 +280,721 @@ class Sample(models.Model):
         self.modified = datetime.now()
         super(Sample, self).save(*args, **kwargs)
 
+    class Meta:
+        # Names are looked up by site; see _resolve.
+        index_together = [('name', 'all_sites_override')]
+
+
+def get_flag_user_ids(flag_id):
+    """The ids of the users a flag is active for, as an :class:`IdSet`.
+
+    This reads the through table directly so no user rows are loaded.
+    """
+    return IdSet(Flag.users.through.objects.filter(
+        flag_id=flag_id).values_list('user_id', flat=True))
+
+
+def get_flag_group_ids(flag_id):
+    """The ids of the groups a flag is active for, as an :class:`IdSet`."""
+    return IdSet(Flag.groups.through.objects.filter(
+        flag_id=flag_id).values_list('group_id', flat=True))
+
+
+def _related_ids(through, field, related_field, pks):
+    """Map each of ``pks`` to the ids it's related to in ``through``."""
+    related = defaultdict(list)
+    rows = through.objects.filter(**{field + '__in': pks}).values_list(
+        field, related_field)
+    for pk, related_id in rows:
+        related[pk].append(related_id)
+    return related
+
+
+class _Loaded(dict):
+    """Compiled entries by name, as returned by the ``load_*`` functions.
+
+    ``per_site`` holds the names shared by objects on different sites,
+    which resolve to a different object (or none) depending on the site.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_Loaded, self).__init__(*args, **kwargs)
+        self.per_site = set()
+
+
+def _resolve(model, queryset, site):
+    """Pick the object each name resolves to on ``site``.
+
+    An object on ``site`` itself wins over one on all sites, and among
+    equals the first created does. A name only used by objects on other
+    sites resolves to the first of those, which is off on ``site``. Without
+    a ``site``, names shared by objects on different sites are left out.
+
+    Returns the chosen objects by name, the names that depend on the site
+    and the site ids of the chosen objects that aren't on all sites.
+    """
+    objects = list(queryset.order_by('pk'))
+    through = model.site.through
+    field = model._meta.model_name + '_id'
+    sites = _related_ids(through, field, 'site_id',
+                         [o.pk for o in objects if not o.all_sites_override])
+    candidates = OrderedDict()
+    for obj in objects:
+        candidates.setdefault(obj.name, []).append(obj)
+    chosen = {}
+    per_site = set()
+    for name, objs in candidates.items():
+        if all(o.all_sites_override for o in objs):
+            chosen[name] = objs[0]
+            continue
+        per_site.add(name)
+        if site is None:
+            continue
+        on_site = [o for o in objs if o.all_sites_override or
+                   site.pk in sites[o.pk]]
+        on_site.sort(key=lambda o: o.all_sites_override)
+        chosen[name] = on_site[0] if on_site else objs[0]
+    return chosen, per_site, sites
+
+
+def load_flags(names, site=None):
+    """Load and compile the flags called ``names``, as seen from ``site``.
+
+    This takes four queries however many flags there are. Returns a dict
+    mapping the name of each flag found to ``(rule, user_ids)``, where
+    ``user_ids`` is ``None`` unless there are too many users to inline in
+    the rule.
+    """
+    return _compile_flags(Flag.objects.filter(name__in=names), site)
+
+
+def _compile_flags(queryset, site=None):
+    flags, per_site, sites = _resolve(Flag, queryset, site)
+    pks = [f.pk for f in flags.values()]
+    users = _related_ids(Flag.users.through, 'flag_id', 'user_id', pks)
+    groups = _related_ids(Flag.groups.through, 'flag_id', 'group_id', pks)
+    loaded = _Loaded()
+    loaded.per_site.update(per_site)
+    for name, f in flags.items():
+        f_users = IdSet(users[f.pk])
+        rule = FlagRule.from_flag(f, f_users, groups[f.pk], sites[f.pk])
+        loaded[name] = _flag_entries(rule, f_users)
+    return loaded
+
+
+def load_snapshot(site):
+    """Load every flag, as seen from ``site``.
+
+    Names are resolved like :func:`load_flags` does, so flags only on other
+    sites are kept, and are off on ``site``. This takes at most four
+    queries however many flags there are. Switches and samples are read
+    from their tables instead (see :func:`get_table`).
+    """
+    return Snapshot(site.pk, _compile_flags(Flag.objects.all(), site))
+
+
+def get_snapshot(site):
+    """Return the :class:`~waffle.rules.Snapshot` for ``site``.
+
+    Snapshots are cached under the current generation, so they're replaced
+    whenever anything in them changes. Only one process at a time rebuilds
+    a missing snapshot; the others keep using the previous one meanwhile.
+    """
+    generation = get_generation()
+    key = key_cache.get(('snapshot', site.pk, generation), _snapshot_key,
+                        site.pk, generation)
+    return _get_or_build(key, get_setting('SNAPSHOT_CACHE_KEY') % site.pk,
+                         generation, load_snapshot, site)
+
+
+def _get_or_build(key, logical, version, build, *args):
+    """Read ``key``, or cache ``build(*args)`` under it if it's missing.
+
+    ``logical`` names the entry regardless of ``version``. Only one process
+    at a time builds it; the others serve the last copy built meanwhile.
+    """
+    if _uncommitted():
+        return build(*args)
+    value = cache.get(key)
+    if value is None:
+        lock = lock_key('%s@%s' % (logical, version))
+        stale = stale_key(logical)
+        held = cache.add(lock, 1, get_setting('CACHE_LOCK_TIMEOUT'))
+        if not held:
+            value = cache.get(stale)
+            if value is not None:
+                return value
+        try:
+            value = build(*args)
+            cache.add(key, value)
+            cache.set(stale, value, get_setting('STALE_CACHE_TIMEOUT'))
+        finally:
+            # Only release a lock we took; another process may hold it.
+            if held:
+                cache.delete(lock)
+    return value
+
+
+def _snapshot_key(site_id, generation):
+    # Snapshots hold rules, so they're kept apart per rule format.
+    return build_key(get_setting('SNAPSHOT_CACHE_KEY'),
+                     '%s@%s/%s' % (site_id, generation, rules.FORMAT))
+
+
+def load_switch_table(site):
+    """Load whether each switch is active on ``site``, in one query.
+
+    Returns a dict mapping switch names to booleans. Switches that aren't
+    on ``site`` are ``False`` there, not missing.
+    """
+    table = {}
+    rows = _by_site(Switch, site).values_list('name', 'active', 'on_site')
+    for name, active, on_site in rows:
+        table.setdefault(name, bool(active and on_site))
+    return table
+
+
+def load_sample_table(site):
+    """Load the threshold of each sample on ``site``, in one query.
+
+    Returns a dict mapping sample names to their percentage in tenths of a
+    percent (see :func:`~waffle.rules.percent_threshold`). Samples that
+    aren't on ``site`` have a threshold of ``0`` there, not none.
+    """
+    table = {}
+    rows = _by_site(Sample, site).values_list('name', 'percent', 'on_site')
+    for name, percent, on_site in rows:
+        if name not in table:
+            table[name] = rules.percent_threshold(percent) if on_site else 0
+    return table
+
+
+TABLES = {
+    'SWITCH_TABLE_CACHE_KEY': load_switch_table,
+    'SAMPLE_TABLE_CACHE_KEY': load_sample_table,
+}
+
+
+def table_version_key(table_setting):
+    """The key of the version counter shared by every site's table."""
+    return keyfmt(get_setting('VERSION_CACHE_KEY'),
+                  get_setting(table_setting) % 'all')
+
+
+def get_table(table_setting, site):
+    """Return the table of ``site`` cached under ``table_setting``.
+
+    Tables are cached under a version shared by all sites, which moves on
+    whenever anything in them or any site changes, so checking any number
+    of names is one read of the version and one of the table.
+    """
+    version_key = table_version_key(table_setting)
+    version = get_versions([version_key])[version_key]
+    return _get_or_build(_table_key(table_setting, site, version),
+                         get_setting(table_setting) % site.pk, version,
+                         TABLES[table_setting], site)
+
+
+def write_table(table_setting, site):
+    """Rebuild the table of ``site`` and cache it under the current version.
+
+    This is what ``WAFFLE_WRITE_THROUGH`` does once a switch or sample
+    changes, so the next check on ``site`` doesn't miss.
+    """
+    version_key = table_version_key(table_setting)
+    version = get_versions([version_key])[version_key]
+    table = TABLES[table_setting](site)
+    cache.set(_table_key(table_setting, site, version), table)
+    cache.set(stale_key(get_setting(table_setting) % site.pk), table,
+              get_setting('STALE_CACHE_TIMEOUT'))
+    return table
+
+
+def _table_key(table_setting, site, version):
+    return keyfmt(get_setting(table_setting), '%s@%s' % (site.pk, version))
+
+
+def get_switch_table(site):
+    """Return the switch table of ``site`` (see :func:`load_switch_table`)."""
+    return get_table('SWITCH_TABLE_CACHE_KEY', site)
+
+
+def get_sample_table(site):
+    """Return the sample table of ``site`` (see :func:`load_sample_table`)."""
+    return get_table('SAMPLE_TABLE_CACHE_KEY', site)
+
+
+def uncache_tables(**kwargs):
+    """Retire the switch and sample tables of every site."""
+    for table_setting in TABLES:
+        bump(table_version_key(table_setting))
+    bump_generation()
+
+post_save.connect(uncache_tables, sender=Site,
+                  dispatch_uid='save_site_tables')
+post_delete.connect(uncache_tables, sender=Site,
+                    dispatch_uid='delete_site_tables')
+
+
+def lock_key(logical):
+    """The key of the lock held while rebuilding the entry ``logical``."""
+    return key_cache.get(('lock', logical), build_key,
+                         get_setting('LOCK_CACHE_KEY'), logical)
+
+
+def stale_key(logical):
+    """The key of the last copy built of the entry ``logical``.
+
+    Stale copies outlive invalidation, and are served while another process
+    holds the lock to rebuild the entry.
+    """
+    return key_cache.get(('stale', logical), build_key,
+                         get_setting('STALE_CACHE_KEY'),
+                         '%s/%s' % (logical, rules.FORMAT))
+
+
+def object_stale_key(key_settings, name, site):
+    """The key of the last copy built of the object ``name`` on ``site``."""
+    return key_cache.get(('stale', key_settings[0], name, site.id),
+                         _object_stale_key, key_settings, name, site.id)
+
+
+def _object_stale_key(key_settings, name, site_id):
+    return stale_key('%s:%d' % (get_setting(key_settings[0]) % name,
+                                site_id))
+
+
+def _expiring(copy, beta, now):
+    """Whether to rebuild an entry early, given its stale copy.
+
+    This is the "XFetch" algorithm: the closer an entry is to expiring, and
+    the longer it took to build, the likelier it is to be rebuilt now, so
+    that usually one process rebuilds it shortly before it expires.
+    """
+    if copy is None or copy[0] is None:
+        return False
+    expires, delta = copy[0], copy[1]
+    return now - delta * beta * math.log(1.0 - random.random()) >= expires
+
+
+FLAG_KEYS = ('FLAG_CACHE_KEY', 'FLAG_USERS_CACHE_KEY')
+
+
+def version_key(key_settings, name):
+    """The key of the version counter of the object called ``name``."""
+    return key_cache.get(('version', key_settings[0], name), _version_key,
+                         key_settings, name)
+
+
+def _version_key(key_settings, name):
+    return build_key(get_setting('VERSION_CACHE_KEY'),
+                     get_setting(key_settings[0]) % name)
+
+
+def get_object_versions(key_settings, names):
+    """The current versions of the objects called ``names``, by name."""
+    keys = dict((name, version_key(key_settings, name)) for name in names)
+    versions = get_versions(list(keys.values()))
+    return dict((name, versions[key]) for name, key in keys.items())
+
+
+def cache_keys(key_settings, name, version, site=None):
+    """The keys of the cache entries for ``name``, one per key setting.
+
+    Every key includes the version of the object, so bumping the version
+    (see :func:`uncache`) retires all of its entries at once.
+
+    Objects that apply to all sites are cached once, without a site. For
+    the others, the key without a site holds ``PER_SITE`` and the entries
+    live under keys for each site.
+    """
+    return _cache_keys(key_settings, name, version,
+                       None if site is None else site.id)
+
+
+def _cache_keys(key_settings, name, version, site_id):
+    return key_cache.get((key_settings, name, version, site_id),
+                         _build_cache_keys, key_settings, name, version,
+                         site_id)
+
+
+def _build_cache_keys(key_settings, name, version, site_id):
+    if site_id is None:
+        unique = '%s@%s' % (name, version)
+    else:
+        unique = '%s@%s:%d' % (name, version, site_id)
+    return tuple(build_key(get_setting(k), unique) for k in key_settings)
+
+
+def _cache_data(key_settings, name, version, entries, site_ids):
+    # Entries that are None (like the users of a flag small enough to hold
+    # them itself) aren't stored at all.
+    if site_ids is None:
+        return dict((k, v) for k, v in
+                    zip(_cache_keys(key_settings, name, version, None),
+                        entries) if v is not None)
+    data = {_cache_keys(key_settings, name, version, None)[0]: PER_SITE}
+    for site_id in site_ids:
+        data.update((k, v) for k, v in
+                    zip(_cache_keys(key_settings, name, version, site_id),
+                        entries) if v is not None)
+    return data
+
+
+def fetch_cached(names, key_settings, site, load):
+    """Fetch the cache entries of ``names`` as seen from ``site``.
+
+    Each name has one entry per setting in ``key_settings``, the first being
+    the object itself. Anything that isn't cached is loaded with ``load``,
+    which returns a tuple of entries by name, and cached. This takes two
+    round trips to the cache (versions, then entries), or three if any of
+    the objects are site-specific.
+
+    Only one process at a time loads a missing name: the others serve the
+    last copy built (see :func:`stale_key`) until it's done, or load it
+    themselves if there is no copy. With ``WAFFLE_CACHE_EARLY_REFRESH`` set,
+    entries are also rebuilt shortly before they'd expire.
+
+    Returns a dict mapping each name to its tuple of entries, or to ``None``
+    if there is no such object.
+    """
+    if _uncommitted():
+        loaded = load(names, site)
+        return dict((name, loaded.get(name)) for name in names)
+    versions = get_object_versions(key_settings, names)
+    keys = dict((name, cache_keys(key_settings, name, versions[name]))
+                for name in names)
+    kind = get_setting(key_settings[0])
+    beta = get_setting('CACHE_EARLY_REFRESH')
+    fetch = [k for ks in keys.values() for k in ks]
+    if beta:
+        # Every copy is read to decide what to refresh early.
+        stale_keys = dict((name, object_stale_key(key_settings, name, site))
+                          for name in names)
+        fetch.extend(stale_keys.values())
+    cached = cache.get_many(fetch)
+
+    per_site = [name for name, ks in keys.items()
+                if cached.get(ks[0]) == PER_SITE]
+    if per_site:
+        for name in per_site:
+            keys[name] = cache_keys(key_settings, name, versions[name], site)
+        cached.update(cache.get_many(
+            [k for name in per_site for k in keys[name]]))
+
+    # Entries in another format unpickle as None; those are misses too.
+    missing = [name for name, ks in keys.items() if cached.get(ks[0]) is None]
+    if beta:
+        now = time.time()
+        missing.extend(name for name in names if name not in missing and
+                       _expiring(cached.get(stale_keys[name]), beta, now))
+    else:
+        stale_keys = dict((name, object_stale_key(key_settings, name, site))
+                          for name in missing)
+
+    served = {}
+    held = []
+    if missing:
+        locks = dict((name, lock_key('%s@%s' % (kind % name, versions[name])))
+                     for name in missing)
+        lock_timeout = get_setting('CACHE_LOCK_TIMEOUT')
+        held = [name for name in missing
+                if cache.add(locks[name], 1, lock_timeout)]
+        waiting = [name for name in missing if name not in held]
+        if waiting:
+            if beta:
+                copies = cached
+            else:
+                copies = cache.get_many([stale_keys[n] for n in waiting])
+            for name in waiting:
+                copy = copies.get(stale_keys[name])
+                if cached.get(keys[name][0]) is None and copy is not None:
+                    served[name] = copy[2]
+        # Load what we hold the lock for, and whatever there's nothing at
+        # all to serve for. Entries only due for an early refresh that
+        # someone else is doing are fine as they are.
+        missing = [name for name in missing if name in held or
+                   (cached.get(keys[name][0]) is None and
+                    name not in served)]
+
+    try:
+        if missing:
+            start = time.time()
+            loaded = load(missing, site)
+            delta = time.time() - start
+            backfill = {}
+            absent = {}
+            copies = {}
+            timeout = getattr(cache, 'default_timeout', None)
+            for name in missing:
+                version = versions[name]
+                if name not in loaded:
+                    key = cache_keys(key_settings, name, version)[0]
+                    absent[key] = ABSENT
+                    copies[stale_keys[name]] = (
+                        start + get_setting('ABSENT_CACHE_TIMEOUT'), delta,
+                        None)
+                    continue
+                entries = loaded[name]
+                if (entries[0].all_sites_override and
+                        name not in loaded.per_site):
+                    keys[name] = cache_keys(key_settings, name, version)
+                    sites = None
+                else:
+                    keys[name] = cache_keys(key_settings, name, version, site)
+                    sites = [site.id]
+                backfill.update(_cache_data(key_settings, name, version,
+                                            entries, sites))
+                expires = None if timeout is None else start + timeout
+                copies[stale_keys[name]] = (expires, delta, entries)
+            if backfill:
+                cache.set_many(backfill)
+                cached.update(backfill)
+            if absent:
+                cache.set_many(absent, get_setting('ABSENT_CACHE_TIMEOUT'))
+                cached.update(absent)
+            cache.set_many(copies, get_setting('STALE_CACHE_TIMEOUT'))
+    finally:
+        if held:
+            cache.delete_many([locks[name] for name in held])
+
+    found = {}
+    for name, ks in keys.items():
+        if name in served:
+            found[name] = served[name]
+            continue
+        obj = cached.get(ks[0])
+        if obj is None or obj == ABSENT or obj == PER_SITE:
+            found[name] = None
+        else:
+            found[name] = tuple(cached.get(k) for k in ks)
+    return found
+
+
+def _cache_object(model, key_settings, entries):
+    rule = entries[0]
+    if model.objects.filter(name=rule.name).exclude(pk=rule.pk).exists():
+        # Which object the name is depends on the site; leave it to readers.
+        return
+    version = get_object_versions(key_settings, [rule.name])[rule.name]
+    for k, v in _cache_data(key_settings, rule.name, version, entries,
+                            rule.site_ids).items():
+        cache.add(k, v)
+
+
+def uncache(key_settings, obj, all_key_setting, load=None, action=None,
+            using=None):
+    """Retire every cache entry of ``obj``, on every site.
+
+    This bumps the version of the object, the ``all_key_setting`` list and
+    the generation: a fixed number of round trips however many sites there
+    are. Entries under the old version are never read again and expire on
+    their own.
+
+    With ``WAFFLE_WRITE_THROUGH`` on, the object is then reloaded with
+    ``load`` and written straight under its new version, so the next check
+    doesn't miss. ``action`` is that of the ``m2m_changed`` signal, if any.
+
+    Inside a transaction, the entries are retired right away, and again
+    once the transaction on the ``using`` database commits, since other
+    processes may have cached the old object meanwhile. Each pass (and any
+    write-through) is done once per object however many times it's saved
+    or its relations change in the meantime. Until the commit, checks made
+    in the transaction read the database without caching what they read,
+    so they see its changes. Django versions without
+    ``transaction.on_commit`` do it all right away.
+    """
+    pending = _pending(using)
+    if pending is not None:
+        if (key_settings, obj.name) not in pending.objects:
+            # Nothing is written through yet: the changes aren't committed.
+            now = _Invalidations()
+            now.add(key_settings, obj.name, all_key_setting, None)
+            now.run()
+        # Everything has been saved by the time this runs.
+        pending.add(key_settings, obj.name, all_key_setting, load)
+        return
+
+    invalidations = _Invalidations()
+    if action and action.startswith('pre_'):
+        load = None
+    invalidations.add(key_settings, obj.name, all_key_setting, load)
+    invalidations.run()
+
+
+def uncache_table(table_setting, all_key_setting, action=None, using=None):
+    """Retire the table under ``table_setting``, on every site.
+
+    This bumps the version every site's table shares, the
+    ``all_key_setting`` list and the generation. With
+    ``WAFFLE_WRITE_THROUGH`` on, the current site's table is then rebuilt
+    (see :func:`write_table`). Transactions are handled like
+    :func:`uncache` does.
+    """
+    pending = _pending(using)
+    if pending is not None:
+        if table_setting not in pending.tables:
+            now = _Invalidations()
+            now.add_table(table_setting, all_key_setting, False)
+            now.run()
+        pending.add_table(table_setting, all_key_setting, True)
+        return
+
+    invalidations = _Invalidations()
+    write = not (action and action.startswith('pre_'))
+    invalidations.add_table(table_setting, all_key_setting, write)
+    invalidations.run()
+
+
+def _pending(using):
+    """The invalidations waiting for the transaction on ``using`` to commit.
+
+    Returns ``None`` outside a transaction, or on Django versions without
+    ``transaction.on_commit``.
+    """
+    connection = transaction.get_connection(using)
+    if not (hasattr(transaction, 'on_commit') and
+            connection.in_atomic_block):
+        return None
+    invalidations = getattr(connection, '_waffle_invalidations', None)
+    if (invalidations is None or
+            invalidations.queue is not connection.run_on_commit):
+        # The transaction these were collected in is over (committed, or
+        # rolled back and the callback dropped), so start afresh.
+        invalidations = _Invalidations()
+        transaction.on_commit(invalidations.run, using)
+        invalidations.queue = connection.run_on_commit
+        connection._waffle_invalidations = invalidations
+    return invalidations
+
+
+def _uncommitted():
+    """Whether this transaction changed anything waffle caches.
+
+    Until it commits, reads bypass the cache rather than fill it with what
+    only this transaction can see (see :func:`uncache`).
+    """
+    if not hasattr(transaction, 'on_commit'):
+        return False
+    connection = transaction.get_connection()
+    invalidations = getattr(connection, '_waffle_invalidations', None)
+    return (invalidations is not None and connection.in_atomic_block and
+            invalidations.queue is connection.run_on_commit and
+            bool(invalidations.objects or invalidations.tables))
+
+
+class _Invalidations(object):
+    """Cache invalidations waiting for a transaction to commit."""
+
+    def __init__(self):
+        self.queue = None
+        self.objects = OrderedDict()
+        self.tables = OrderedDict()
+
+    def add(self, key_settings, name, all_key_setting, load):
+        self.objects[(key_settings, name)] = (all_key_setting, load)
+
+    def add_table(self, table_setting, all_key_setting, write):
+        # Writing through once is enough, whatever changed.
+        write = write or self.tables.get(table_setting, (None, False))[1]
+        self.tables[table_setting] = (all_key_setting, write)
+
+    def run(self):
+        all_keys = set()
+        rebuild = []
+        write_through = get_setting('WRITE_THROUGH')
+        for (key_settings, name), (all_key_setting, load) in \
+                self.objects.items():
+            bump(version_key(key_settings, name))
+            if write_through and load is not None:
+                _write_through(key_settings, name, load)
+            all_keys.add(keyfmt(get_setting(all_key_setting)))
+        for table_setting, (all_key_setting, write) in self.tables.items():
+            bump(table_version_key(table_setting))
+            if write_through and write:
+                rebuild.append(table_setting)
+            all_keys.add(keyfmt(get_setting(all_key_setting)))
+        self.objects.clear()
+        self.tables.clear()
+        cache.delete_many(list(all_keys))
+        bump_generation()
+        if rebuild and getattr(settings, 'SITE_ID', None) is not None:
+            # Only the current site's tables; others are rebuilt on demand.
+            site = Site.objects.get_current()
+            for table_setting in rebuild:
+                write_table(table_setting, site)
+
+
+def _write_through(key_settings, name, load):
+    version = get_object_versions(key_settings, [name])[name]
+    loaded = load([name])
+    if name in loaded.per_site:
+        # Which object this is depends on the site; leave it to readers.
+        return
+    entries = loaded.get(name)
+    if entries is None:
+        cache.set(_cache_keys(key_settings, name, version, None)[0], ABSENT,
+                  get_setting('ABSENT_CACHE_TIMEOUT'))
+    else:
+        cache.set_many(_cache_data(key_settings, name, version, entries,
+                                   entries[0].site_ids))
+
+
+def _flag_entries(rule, user_ids):
+    # The users go under their own key only if the rule couldn't hold them.
+    if rule.user_ids is not None or not rule.has_users:
+        return (rule, None)
+    return (rule, user_ids)
+
 
 def cache_flag(**kwargs):
+    """Cache the compiled rule for a flag and return it.
+
+    The flag is stored as one :class:`~waffle.rules.FlagRule` holding its
+    user and group ids, unless it has more than ``WAFFLE_FLAG_INLINE_USERS``
+    users; those are then stored as a set of ids under their own key.
+    """
     action = kwargs.get('action', None)
     # action is included for m2m_changed signal. Only cache on the post_*.
     if not action or action in ['post_add', 'post_remove', 'post_clear']:
         f = kwargs.get('instance')
-        f_users = f.users.all()
-        f_groups = f.groups.all()
-        for x in f.get_sites():
-            cache.add(keyfmt(get_setting('FLAG_CACHE_KEY'),
-                             f.name, x), f)
-            cache.add(keyfmt(get_setting('FLAG_CACHE_KEY'),
-                             f.name, x), f)
-            cache.add(keyfmt(get_setting('FLAG_USERS_CACHE_KEY'),
-                             f.name, x), f_users)
-            cache.add(keyfmt(get_setting('FLAG_GROUPS_CACHE_KEY'),
-                             f.name, x), f_groups)
+        f_users = get_flag_user_ids(f.pk)
+        rule = FlagRule.from_flag(f, f_users, get_flag_group_ids(f.pk))
+        _cache_object(Flag, FLAG_KEYS, _flag_entries(rule, f_users))
+        return rule
+
+
+def _changed(model, kwargs):
+    """The objects of ``model`` a ``post_save``, ``post_delete`` or
+    ``m2m_changed`` signal is about.
+
+    That's the instance, unless the relation changed from its other side
+    (``user.flag_set.add(flag)``, say), in which case the instance is the
+    user and the flags are looked up by ``pk_set``. Clearing the relation
+    from the other side has no ``pk_set``, so the objects related before
+    are remembered on the instance at ``pre_clear``.
+    """
+    instance = kwargs.get('instance')
+    if not kwargs.get('reverse'):
+        return [instance]
+    action = kwargs.get('action')
+    memo = '_waffle_cleared_%s' % model._meta.model_name
+    if action == 'pre_clear':
+        sender = kwargs.get('sender')
+        field = [f.name for f in model._meta.many_to_many
+                 if getattr(model, f.name).through is sender][0]
+        objs = list(model.objects.filter(**{field: instance}))
+        setattr(instance, memo, objs)
+        return objs
+    if action == 'post_clear':
+        return getattr(instance, memo, [])
+    return list(model.objects.filter(pk__in=kwargs.get('pk_set') or ()))
 
 
 def uncache_flag(**kwargs):
-    flag = kwargs.get('instance')
-    data = []
-    for x in get_all_sites():
-        data.append(keyfmt(get_setting('FLAG_CACHE_KEY'),
-                           flag.name, x))
-        data.append(keyfmt(get_setting('FLAG_USERS_CACHE_KEY'),
-                           flag.name, x))
-        data.append(keyfmt(get_setting('FLAG_GROUPS_CACHE_KEY'),
-                           flag.name, x))
-    data.append(keyfmt(get_setting('ALL_FLAGS_CACHE_KEY')))
-
-    cache.delete_many(data)
+    for flag in _changed(Flag, kwargs):
+        uncache(FLAG_KEYS, flag, 'ALL_FLAGS_CACHE_KEY', load_flags,
+                kwargs.get('action'), kwargs.get('using'))
 
 post_save.connect(uncache_flag, sender=Flag, dispatch_uid='save_flag')
 post_delete.connect(uncache_flag, sender=Flag, dispatch_uid='delete_flag')
@@ -274,41 +1002,57 @@ m2m_changed.connect(uncache_flag, sender=Flag.users.through,
                     dispatch_uid='m2m_flag_users')
 m2m_changed.connect(uncache_flag, sender=Flag.groups.through,
                     dispatch_uid='m2m_flag_groups')
+m2m_changed.connect(uncache_flag, sender=Flag.site.through,
+                    dispatch_uid='m2m_flag_sites')
+
 
+def uncache_user_groups(**kwargs):
+    """Forget the group ids remembered on a user whose groups changed."""
+    instance = kwargs.get('instance')
+    if hasattr(instance, '_waffle_group_ids'):
+        del instance._waffle_group_ids
 
-def cache_sample(**kwargs):
-    sample = kwargs.get('instance')
-    for x in sample.get_sites():
-        cache.add(keyfmt(get_setting('SAMPLE_CACHE_KEY'),
-                         sample.name, x), sample)
+
+_user_groups_connected = False
+
+
+def connect_user_groups():
+    """Connect :func:`uncache_user_groups` to the user model's groups.
+
+    The user model is swappable, so it can't be looked up while this module
+    is imported, and may not have groups at all. This is called the first
+    time a user's group ids are remembered instead.
+    """
+    global _user_groups_connected
+    if _user_groups_connected:
+        return
+    groups = getattr(get_user_model(), 'groups', None)
+    through = getattr(groups, 'through', None)
+    if through is not None:
+        m2m_changed.connect(uncache_user_groups, sender=through,
+                            dispatch_uid='m2m_user_groups')
+    _user_groups_connected = True
 
 
 def uncache_sample(**kwargs):
-    sample = kwargs.get('instance')
-    for x in get_all_sites():
-        cache.set(keyfmt(get_setting('SAMPLE_CACHE_KEY'),
-                         sample.name, x), None, 5)
-    cache.delete(keyfmt(get_setting('ALL_SAMPLES_CACHE_KEY')))
+    # Samples are only read from the sample table, whichever one changed.
+    uncache_table('SAMPLE_TABLE_CACHE_KEY', 'ALL_SAMPLES_CACHE_KEY',
+                  kwargs.get('action'), kwargs.get('using'))
 
 post_save.connect(uncache_sample, sender=Sample, dispatch_uid='save_sample')
 post_delete.connect(uncache_sample, sender=Sample,
                     dispatch_uid='delete_sample')
-
-
-def cache_switch(**kwargs):
-    switch = kwargs.get('instance')
-    for site in switch.get_sites():
-        cache.add(keyfmt(get_setting('SWITCH_CACHE_KEY'),
-                         switch.name, site), switch)
+m2m_changed.connect(uncache_sample, sender=Sample.site.through,
+                    dispatch_uid='m2m_sample_sites')
 
 
 def uncache_switch(**kwargs):
-    switch = kwargs.get('instance')
-    for site in get_all_sites():
-        cache.delete(keyfmt(get_setting('SWITCH_CACHE_KEY'),
-                            switch.name, site))
-    cache.delete(keyfmt(get_setting('ALL_SWITCHES_CACHE_KEY')))
+    # Switches are only read from the switch table, whichever one changed.
+    uncache_table('SWITCH_TABLE_CACHE_KEY', 'ALL_SWITCHES_CACHE_KEY',
+                  kwargs.get('action'), kwargs.get('using'))
 
 post_delete.connect(uncache_switch, sender=Switch,
                     dispatch_uid='delete_switch')
 post_save.connect(uncache_switch, sender=Switch, dispatch_uid='save_switch')
+m2m_changed.connect(uncache_switch, sender=Switch.site.through,
+                    dispatch_uid='m2m_switch_sites')
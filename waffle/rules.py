@@ -0,0 +1,375 @@
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_left
+from decimal import Decimal
+from numbers import Integral
+import sys
+
+from waffle.utils import get_setting
+
+
+# Cached in place of flags, switches and samples that don't exist, so that
+# checking an unknown name doesn't hit the database every time.
+ABSENT = '__absent__'
+
+# Cached under the site-less key of objects that only apply to some sites,
+# to say the real entries are under per-site keys.
+PER_SITE = '__per_site__'
+
+
+# The version of the format rules are pickled in. Bump it whenever what
+# ``_encode`` returns, or what a ``Snapshot`` holds, changes; entries in any
+# other format are unpickled as ``None``, which reads as a cache miss.
+FORMAT = 4
+
+
+def _load_rule(code, version, *values):
+    if version != FORMAT:
+        return None
+    return _RULES[code]._decode(values)
+
+
+def percent_threshold(percent):
+    """Convert a percentage (0.0 - 100.0) to an integer in tenths."""
+    if not percent:
+        return 0
+    return int((Decimal(str(percent)) * 10).to_integral_value())
+
+
+def _typecode(max_id):
+    """The smallest unsigned array type code that can hold ``max_id``."""
+    for code in ('B', 'H', 'I', 'L', 'Q'):
+        try:
+            array(str(code), [max_id])
+        except (OverflowError, ValueError):
+            continue
+        return str(code)
+    raise OverflowError('id %r is too large' % max_id)
+
+
+def _load_id_set(typecode, data):
+    ids = array(str(typecode))
+    if hasattr(ids, 'frombytes'):
+        ids.frombytes(data)
+    else:
+        ids.fromstring(data)
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return IdSet._from_array(ids)
+
+
+class IdSet(object):
+    """A compact, immutable set of integer ids.
+
+    The ids are kept in a sorted array, so membership is a binary search
+    and the set pickles to a flat byte string instead of one object per id.
+    Ids that don't fit an unsigned array (custom user models may use UUIDs
+    or strings as keys) are kept in a plain ``frozenset`` instead.
+    """
+    __slots__ = ('_ids',)
+
+    def __init__(self, ids=()):
+        ids = set(ids)
+        if all(isinstance(id_, Integral) and id_ >= 0 for id_ in ids):
+            try:
+                ids = sorted(ids)
+                self._ids = array(_typecode(ids[-1] if ids else 0), ids)
+                return
+            except OverflowError:
+                pass
+        self._ids = frozenset(ids)
+
+    @classmethod
+    def _from_array(cls, ids):
+        obj = cls.__new__(cls)
+        obj._ids = ids
+        return obj
+
+    def __reduce__(self):
+        ids = self._ids
+        if not isinstance(ids, array):
+            return (IdSet, (list(ids),))
+        if sys.byteorder == 'big':
+            ids = array(ids.typecode, ids)
+            ids.byteswap()
+        data = ids.tobytes() if hasattr(ids, 'tobytes') else ids.tostring()
+        return (_load_id_set, (ids.typecode, data))
+
+    def __contains__(self, id_):
+        ids = self._ids
+        if not isinstance(ids, array):
+            return id_ in ids
+        if not isinstance(id_, Integral):
+            return False
+        i = bisect_left(ids, id_)
+        return i < len(ids) and ids[i] == id_
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def isdisjoint(self, ids):
+        """Whether none of ``ids`` are in the set.
+
+        This does one lookup per item of ``ids``, so pass the smaller set.
+        """
+        for id_ in ids:
+            if id_ in self:
+                return False
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __bool__(self):
+        return bool(self._ids)
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet):
+            return self._ids == other._ids
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, IdSet):
+            return self._ids != other._ids
+        return NotImplemented
+
+    def __repr__(self):
+        return 'IdSet(%r)' % list(self._ids)
+
+
+class _Rule(object):
+    """Base for the compiled, immutable forms of waffle's models.
+
+    ``site_ids`` is a frozenset of the ids of the sites a rule applies to,
+    or ``None`` when it applies to all sites.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __reduce__(self):
+        # A short code, the format version and a flat tuple of plain
+        # values: no field names, no model state, nothing evaluation
+        # doesn't need.
+        return (_load_rule, (self._code, FORMAT) + self._encode())
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.name)
+
+    @property
+    def all_sites_override(self):
+        return self.site_ids is None
+
+    def on_site(self, site):
+        return self.site_ids is None or site.id in self.site_ids
+
+
+def _encode_site_ids(site_ids):
+    return None if site_ids is None else tuple(sorted(site_ids))
+
+
+def _site_ids(obj, site_ids):
+    if obj.all_sites_override:
+        return None
+    if site_ids is None:
+        # Uses the prefetched sites, if any.
+        site_ids = [x.pk for x in obj.site.all()]
+    return frozenset(site_ids)
+
+
+class FlagRule(_Rule):
+    """A compiled, immutable form of a :class:`~waffle.models.Flag`.
+
+    Rules are built once when a flag is cached and are what gets stored and
+    evaluated, so a check never splits strings, compares ``Decimal`` values
+    or touches model instances.
+
+    ``percent`` is in tenths of a percent (``0`` - ``1000``). ``has_users``
+    and ``has_groups`` say whether the user and group id sets need to be
+    looked at at all. The sets themselves travel with the rule as
+    ``user_ids`` and ``group_ids``; ``user_ids`` is ``None`` when there are
+    too many users to inline (see ``WAFFLE_FLAG_INLINE_USERS``) and they're
+    cached on their own instead.
+    """
+    __slots__ = ('pk', 'name', 'everyone', 'testing', 'superusers', 'staff',
+                 'authenticated', 'languages', 'percent', 'rollout',
+                 'site_ids', 'has_users', 'has_groups', 'user_ids',
+                 'group_ids')
+
+    def __init__(self, pk, name, everyone=None, testing=False,
+                 superusers=True, staff=False, authenticated=False,
+                 languages=frozenset(), percent=0, rollout=False,
+                 site_ids=None, has_users=False, has_groups=False,
+                 user_ids=None, group_ids=None):
+        setattr_ = super(_Rule, self).__setattr__
+        setattr_('pk', pk)
+        setattr_('name', name)
+        setattr_('everyone', everyone)
+        setattr_('testing', bool(testing))
+        setattr_('superusers', bool(superusers))
+        setattr_('staff', bool(staff))
+        setattr_('authenticated', bool(authenticated))
+        setattr_('languages', frozenset(languages))
+        setattr_('percent', int(percent))
+        setattr_('rollout', bool(rollout))
+        setattr_('site_ids', None if site_ids is None
+                 else frozenset(site_ids))
+        setattr_('has_users', bool(has_users))
+        setattr_('has_groups', bool(has_groups))
+        setattr_('user_ids', _id_set(user_ids))
+        setattr_('group_ids', _id_set(group_ids))
+
+    _code = 'f'
+    _bits = ('testing', 'superusers', 'staff', 'authenticated', 'rollout',
+             'has_users', 'has_groups')
+
+    def _encode(self):
+        bits = 0
+        for i, attr in enumerate(self._bits):
+            if getattr(self, attr):
+                bits |= 1 << i
+        everyone = {None: 0, True: 1, False: 2}[self.everyone]
+        return (self.pk, self.name, bits | everyone << len(self._bits),
+                tuple(sorted(self.languages)), self.percent,
+                _encode_site_ids(self.site_ids), self.user_ids,
+                self.group_ids)
+
+    @classmethod
+    def _decode(cls, values):
+        (pk, name, bits, languages, percent, site_ids, user_ids,
+         group_ids) = values
+        kwargs = dict((attr, bool(bits & 1 << i))
+                      for i, attr in enumerate(cls._bits))
+        everyone = (None, True, False)[bits >> len(cls._bits)]
+        return cls(pk, name, everyone=everyone, languages=languages,
+                   percent=percent, site_ids=site_ids, user_ids=user_ids,
+                   group_ids=group_ids, **kwargs)
+
+    @classmethod
+    def from_flag(cls, flag, user_ids=None, group_ids=None, site_ids=None):
+        """Compile ``flag``.
+
+        ``user_ids`` and ``group_ids`` are the id sets the rule will be
+        checked against and ``site_ids`` the sites the flag is on; pass them
+        in if they've already been loaded. Users are left out of the rule if
+        there are more than ``WAFFLE_FLAG_INLINE_USERS`` of them.
+        """
+        if user_ids is None:
+            user_ids = flag.users.values_list('pk', flat=True)
+        user_ids = _id_set(user_ids)
+        if group_ids is None:
+            group_ids = flag.groups.values_list('pk', flat=True)
+        group_ids = _id_set(group_ids)
+        site_ids = _site_ids(flag, site_ids)
+        languages = flag.languages.split(',') if flag.languages else ()
+        inline = len(user_ids) <= get_setting('FLAG_INLINE_USERS')
+        return cls(flag.pk, flag.name,
+                   everyone=flag.everyone,
+                   testing=flag.testing,
+                   superusers=flag.superusers,
+                   staff=flag.staff,
+                   authenticated=flag.authenticated,
+                   languages=languages,
+                   percent=percent_threshold(flag.percent),
+                   rollout=flag.rollout,
+                   site_ids=site_ids,
+                   has_users=bool(user_ids),
+                   has_groups=bool(group_ids),
+                   user_ids=user_ids if inline else None,
+                   group_ids=group_ids)
+
+
+def _id_set(ids):
+    if ids is None or isinstance(ids, IdSet):
+        return ids
+    return IdSet(ids)
+
+
+class SwitchRule(_Rule):
+    """A compiled, immutable form of a :class:`~waffle.models.Switch`."""
+    __slots__ = ('pk', 'name', 'active', 'site_ids')
+
+    def __init__(self, pk, name, active=False, site_ids=None):
+        setattr_ = super(_Rule, self).__setattr__
+        setattr_('pk', pk)
+        setattr_('name', name)
+        setattr_('active', bool(active))
+        setattr_('site_ids', None if site_ids is None
+                 else frozenset(site_ids))
+
+    _code = 'w'
+
+    def _encode(self):
+        return (self.pk, self.name, self.active,
+                _encode_site_ids(self.site_ids))
+
+    @classmethod
+    def _decode(cls, values):
+        pk, name, active, site_ids = values
+        return cls(pk, name, active=active, site_ids=site_ids)
+
+    @classmethod
+    def from_switch(cls, switch, site_ids=None):
+        return cls(switch.pk, switch.name, active=switch.active,
+                   site_ids=_site_ids(switch, site_ids))
+
+
+class SampleRule(_Rule):
+    """A compiled, immutable form of a :class:`~waffle.models.Sample`.
+
+    ``percent`` is in tenths of a percent, like :class:`FlagRule`'s.
+    """
+    __slots__ = ('pk', 'name', 'percent', 'site_ids')
+
+    def __init__(self, pk, name, percent=0, site_ids=None):
+        setattr_ = super(_Rule, self).__setattr__
+        setattr_('pk', pk)
+        setattr_('name', name)
+        setattr_('percent', int(percent))
+        setattr_('site_ids', None if site_ids is None
+                 else frozenset(site_ids))
+
+    _code = 's'
+
+    def _encode(self):
+        return (self.pk, self.name, self.percent,
+                _encode_site_ids(self.site_ids))
+
+    @classmethod
+    def _decode(cls, values):
+        pk, name, percent, site_ids = values
+        return cls(pk, name, percent=percent, site_ids=site_ids)
+
+    @classmethod
+    def from_sample(cls, sample, site_ids=None):
+        return cls(sample.pk, sample.name,
+                   percent=percent_threshold(sample.percent),
+                   site_ids=_site_ids(sample, site_ids))
+
+
+_RULES = dict((cls._code, cls) for cls in (FlagRule, SwitchRule, SampleRule))
+
+
+class Snapshot(object):
+    """Every flag of one site, keyed by name.
+
+    ``flags`` maps names to ``(rule, user_ids)`` tuples, ``user_ids`` being
+    ``None`` unless the rule has too many users to inline. Names missing
+    from a snapshot don't exist. Switches and samples are read from their
+    tables instead.
+    """
+    __slots__ = ('site_id', 'flags')
+
+    def __init__(self, site_id, flags):
+        setattr_ = super(Snapshot, self).__setattr__
+        setattr_('site_id', site_id)
+        setattr_('flags', flags)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, a) for a in self.__slots__))
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import threading
+
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from waffle.local import bump, bump_generation, get_versions
+from waffle.utils import get_setting, keyfmt
+
+
+__all__ = ['SiteRegistry', 'site_registry']
+
+
+# Held in place of the sites when there are too many to keep.
+_TOO_MANY = object()
+
+
+def sites_version_key():
+    """The key of the version counter of the sites, shared by processes."""
+    return keyfmt(get_setting('VERSION_CACHE_KEY'), 'sites')
+
+
+class SiteRegistry(object):
+    """A process-wide, thread-safe map of site ids to sites.
+
+    Every site is loaded in one query the first time one is needed, and
+    kept until a site is saved or deleted in any process (see
+    :func:`sites_changed`), which each lookup checks with one cache read. If
+    there are more than ``WAFFLE_SITE_REGISTRY_SIZE`` sites, none are kept
+    and every lookup queries the database instead.
+    """
+
+    def __init__(self):
+        self._sites = None
+        self._version = None
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _get(self):
+        key = sites_version_key()
+        version = get_versions([key])[key]
+        with self._lock:
+            sites, epoch = self._sites, self._epoch
+            if self._version != version:
+                sites = None
+        if sites is None:
+            size = get_setting('SITE_REGISTRY_SIZE')
+            rows = list(Site.objects.order_by('pk')[:size + 1])
+            if len(rows) > size:
+                sites = _TOO_MANY
+            else:
+                sites = OrderedDict((site.pk, site) for site in rows)
+            with self._lock:
+                # Don't keep what was loaded if sites changed meanwhile.
+                if self._epoch == epoch:
+                    self._sites = sites
+                    self._version = version
+        return None if sites is _TOO_MANY else sites
+
+    def all(self):
+        """Every site, in order of id."""
+        sites = self._get()
+        if sites is None:
+            return list(Site.objects.order_by('pk'))
+        return list(sites.values())
+
+    def get_many(self, site_ids):
+        """The sites with ids in ``site_ids`` that exist, in order of id.
+
+        Sites the registry doesn't know yet, say if they were added without
+        signals, are looked up in the database, and the registry is loaded
+        afresh on next use.
+        """
+        sites = self._get()
+        if sites is None:
+            return list(Site.objects.filter(pk__in=site_ids).order_by('pk'))
+        site_ids = sorted(set(site_ids))
+        unknown = [pk for pk in site_ids if pk not in sites]
+        if not unknown:
+            return [sites[pk] for pk in site_ids]
+        found = dict((site.pk, site) for site in
+                     Site.objects.filter(pk__in=unknown))
+        if found:
+            self.clear()
+        found.update((pk, sites[pk]) for pk in site_ids if pk in sites)
+        return [found[pk] for pk in site_ids if pk in found]
+
+    def clear(self):
+        """Forget every site; they're loaded again on next use."""
+        with self._lock:
+            self._sites = None
+            self._epoch += 1
+
+
+site_registry = SiteRegistry()
+
+
+def _refresh_sites():
+    bump(sites_version_key())
+    bump_generation()
+    site_registry.clear()
+
+
+def sites_changed(**kwargs):
+    """Refresh :data:`site_registry` once a change to a site is committed.
+
+    This moves the shared version of the sites on, so every process loads
+    them again, not just this one. Doing it any earlier would let another
+    thread load the sites as they were before the change. Django versions
+    without ``transaction.on_commit`` do it right away.
+    """
+    using = kwargs.get('using')
+    if (hasattr(transaction, 'on_commit') and
+            transaction.get_connection(using).in_atomic_block):
+        transaction.on_commit(_refresh_sites, using)
+    else:
+        _refresh_sites()
+
+post_save.connect(sites_changed, sender=Site, dispatch_uid='save_site')
+post_delete.connect(sites_changed, sender=Site, dispatch_uid='delete_site')
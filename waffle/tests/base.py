@@ -1,9 +1,15 @@
 from django import test
 from django.core import cache
 
+from waffle.compat import cache as waffle_cache
+from waffle.sites import site_registry
+
 
 class TestCase(test.TransactionTestCase):
 
     def _pre_setup(self):
         cache.cache.clear()
+        # Also drops anything held in the process-local layer.
+        waffle_cache.clear()
+        site_registry.clear()
         super(TestCase, self)._pre_setup()
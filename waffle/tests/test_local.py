@@ -0,0 +1,117 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+import mock
+
+from waffle import local
+from waffle.local import LocalCache
+from waffle.utils import get_setting, keyfmt
+
+
+class LocalCacheTests(TestCase):
+    def setUp(self):
+        super(LocalCacheTests, self).setUp()
+        self.shared = LocMemCache('waffle-local-tests', {})
+        self.shared.clear()
+        self.cache = LocalCache(self.shared, 10)
+        self.generation_key = keyfmt(get_setting('GENERATION_CACHE_KEY'))
+
+    def bump_elsewhere(self):
+        """Bump the generation as another process would."""
+        try:
+            self.shared.incr(self.generation_key)
+        except ValueError:
+            self.shared.set(self.generation_key, 1)
+
+    @mock.patch.object(local.time, 'time')
+    def test_reads_are_kept(self, time):
+        time.return_value = 100
+        self.shared.set('foo', 'bar')
+        self.assertEqual('bar', self.cache.get('foo'))
+
+        self.shared.delete('foo')
+        self.assertEqual('bar', self.cache.get('foo'))
+        self.assertEqual({'foo': 'bar'}, self.cache.get_many(['foo', 'baz']))
+
+    @mock.patch.object(local.time, 'time')
+    def test_generation_change(self, time):
+        time.return_value = 100
+        self.shared.set('foo', 'bar')
+        self.cache.get('foo')
+        self.shared.set('foo', 'baz')
+        self.bump_elsewhere()
+
+        time.return_value = 105  # Not time to revalidate yet.
+        self.assertEqual('bar', self.cache.get('foo'))
+        time.return_value = 111
+        self.assertEqual('baz', self.cache.get('foo'))
+
+    @mock.patch.object(local.time, 'time')
+    def test_unchanged_generation(self, time):
+        time.return_value = 100
+        self.shared.set('foo', 'bar')
+        self.cache.get('foo')
+        self.shared.delete('foo')
+
+        time.return_value = 111
+        self.assertEqual('bar', self.cache.get('foo'))
+
+    def test_writes(self):
+        self.cache.set('foo', 'bar')
+        self.assertEqual('bar', self.shared.get('foo'))
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual({'a': 1, 'b': 2}, self.shared.get_many(['a', 'b']))
+        assert not self.cache.add('a', 3)
+        self.assertEqual(1, self.cache.get('a'))
+
+        self.cache.delete('foo')
+        self.cache.delete_many(['a'])
+        self.assertEqual(None, self.cache.get('foo'))
+        self.assertEqual({'b': 2}, self.cache.get_many(['a', 'b']))
+
+    def test_missing_not_kept(self):
+        self.assertEqual(None, self.cache.get('foo'))
+        self.shared.set('foo', 'bar')
+        self.assertEqual('bar', self.cache.get('foo'))
+
+
+class BumpGenerationTests(TestCase):
+    def setUp(self):
+        super(BumpGenerationTests, self).setUp()
+        self.shared = LocMemCache('waffle-local-tests', {})
+        self.shared.clear()
+        self.cache = LocalCache(self.shared, 10)
+        self.key = keyfmt(get_setting('GENERATION_CACHE_KEY'))
+
+    def test_bump(self):
+        with mock.patch('waffle.compat.cache', self.cache):
+            self.cache.set('foo', 'bar')
+            local.bump_generation()
+            first = self.shared.get(self.key)
+            assert first is not None
+            local.bump_generation()
+            self.assertEqual(first + 1, self.shared.get(self.key))
+
+            # The local copy is dropped right away in this process.
+            self.shared.delete('foo')
+            self.assertEqual(None, self.cache.get('foo'))
+
+
+class VersionTests(TestCase):
+    def setUp(self):
+        super(VersionTests, self).setUp()
+        self.shared = LocMemCache('waffle-version-tests', {})
+        self.shared.clear()
+
+    def test_get_versions_seeds(self):
+        with mock.patch('waffle.compat.cache', self.shared):
+            versions = local.get_versions(['a', 'b'])
+            assert versions['a'] is not None
+            self.assertEqual(versions, local.get_versions(['a', 'b']))
+
+    def test_bump(self):
+        with mock.patch('waffle.compat.cache', self.shared):
+            local.bump('a')
+            first = self.shared.get('a')
+            local.bump('a')
+            self.assertEqual(first + 1, local.get_versions(['a'])['a'])
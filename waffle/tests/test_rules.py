@@ -0,0 +1,184 @@
+import pickle
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+
+from waffle.models import Flag, Sample, Switch
+from waffle import rules
+from waffle.rules import FlagRule, IdSet, SampleRule, SwitchRule
+from waffle.tests.base import TestCase
+
+
+class IdSetTests(TestCase):
+    def test_contains(self):
+        ids = IdSet([5, 3, 9, 3])
+        self.assertEqual([3, 5, 9], list(ids))
+        self.assertEqual(3, len(ids))
+        assert 5 in ids
+        assert 4 not in ids
+        assert 10 not in ids
+        assert None not in ids
+
+    def test_empty(self):
+        ids = IdSet()
+        assert not ids
+        assert 1 not in ids
+
+    def test_large_ids(self):
+        ids = IdSet([1, 2 ** 40])
+        assert 2 ** 40 in ids
+        assert 2 ** 40 + 1 not in ids
+
+    def test_pickle(self):
+        ids = IdSet(range(1, 1000, 3))
+        copy = pickle.loads(pickle.dumps(ids, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(ids, copy)
+        assert 1 in copy
+        assert 2 not in copy
+
+    def test_other_ids(self):
+        ids = IdSet(['b', 'a', 'b'])
+        self.assertEqual(2, len(ids))
+        assert 'a' in ids
+        assert 'c' not in ids
+        assert 1 not in ids
+        assert None not in ids
+        self.assertEqual(ids, pickle.loads(pickle.dumps(ids)))
+
+    def test_lookup_other_types(self):
+        ids = IdSet([1, 2, 3])
+        assert '2' not in ids
+        assert None not in ids
+
+    def test_negative_ids(self):
+        ids = IdSet([-1, 2])
+        assert -1 in ids
+        assert 1 not in ids
+
+    def test_pickle_is_compact(self):
+        ids = list(range(1, 10001))
+        compact = pickle.dumps(IdSet(ids), pickle.HIGHEST_PROTOCOL)
+        plain = pickle.dumps(frozenset(ids), pickle.HIGHEST_PROTOCOL)
+        assert len(compact) < len(plain)
+
+
+class FlagRuleTests(TestCase):
+    def test_from_flag(self):
+        flag = Flag.objects.create(name='myflag', percent='12.5',
+                                   languages='en,fr', staff=True)
+        rule = FlagRule.from_flag(Flag.objects.get(pk=flag.pk))
+        self.assertEqual('myflag', rule.name)
+        self.assertEqual(125, rule.percent)
+        self.assertEqual(frozenset(['en', 'fr']), rule.languages)
+        assert rule.staff
+        assert rule.everyone is None
+        assert rule.site_ids is None
+
+    def test_no_languages(self):
+        rule = FlagRule.from_flag(Flag.objects.create(name='myflag'))
+        self.assertEqual(frozenset(), rule.languages)
+        self.assertEqual(0, rule.percent)
+        assert not rule.has_users
+        assert not rule.has_groups
+
+    def test_has_users(self):
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(User.objects.create(username='foo'))
+        rule = FlagRule.from_flag(flag)
+        assert rule.has_users
+        assert not rule.has_groups
+        self.assertEqual(IdSet(flag.users.values_list('pk', flat=True)),
+                         rule.user_ids)
+        self.assertEqual(IdSet(), rule.group_ids)
+
+    def test_too_many_users(self):
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(User.objects.create(username='foo'),
+                       User.objects.create(username='bar'))
+        with self.settings(WAFFLE_FLAG_INLINE_USERS=1):
+            rule = FlagRule.from_flag(flag)
+        assert rule.has_users
+        self.assertEqual(None, rule.user_ids)
+
+    def test_sites(self):
+        site = Site.objects.get_current()
+        other = Site.objects.create(domain='example2.com')
+        flag = Flag.objects.create(name='myflag', site=site,
+                                   all_sites_override=False)
+        rule = FlagRule.from_flag(flag)
+        self.assertEqual(frozenset([site.pk]), rule.site_ids)
+        assert rule.on_site(site)
+        assert not rule.on_site(other)
+
+    def test_immutable(self):
+        rule = FlagRule(1, 'myflag')
+        with self.assertRaises(AttributeError):
+            rule.everyone = True
+
+    def test_pickle(self):
+        rule = FlagRule(1, 'myflag', everyone=True, languages=['en'],
+                        percent=500, site_ids=[1, 2])
+        copy = pickle.loads(pickle.dumps(rule, pickle.HIGHEST_PROTOCOL))
+        for attr in FlagRule.__slots__:
+            self.assertEqual(getattr(rule, attr), getattr(copy, attr))
+
+    def test_pickle_ids(self):
+        rule = FlagRule(1, 'myflag', has_users=True, user_ids=[3, 1],
+                        has_groups=True, group_ids=[2])
+        copy = pickle.loads(pickle.dumps(rule, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(IdSet([1, 3]), copy.user_ids)
+        self.assertEqual(IdSet([2]), copy.group_ids)
+
+    def test_pickle_everyone(self):
+        for everyone in (None, True, False):
+            rule = FlagRule(1, 'myflag', everyone=everyone, staff=True)
+            copy = pickle.loads(pickle.dumps(rule))
+            self.assertEqual(everyone, copy.everyone)
+            assert copy.staff
+            assert copy.superusers
+            assert not copy.testing
+
+    def test_other_format(self):
+        rule = FlagRule(1, 'myflag')
+        loader, args = rule.__reduce__()
+        self.assertEqual(rules.FORMAT, args[1])
+        args = (args[0], rules.FORMAT + 1) + args[2:]
+        self.assertEqual(None, loader(*args))
+
+
+class SwitchRuleTests(TestCase):
+    def test_from_switch(self):
+        rule = SwitchRule.from_switch(
+            Switch.objects.create(name='myswitch', active=True))
+        assert rule.active
+        assert rule.all_sites_override
+        assert rule.on_site(Site.objects.get_current())
+
+    def test_sites(self):
+        site = Site.objects.get_current()
+        other = Site.objects.create(domain='example2.com')
+        switch = Switch.objects.create(name='myswitch', site=other,
+                                       all_sites_override=False)
+        rule = SwitchRule.from_switch(switch)
+        self.assertEqual(frozenset([other.pk]), rule.site_ids)
+        assert rule.on_site(other)
+        assert not rule.on_site(site)
+
+    def test_pickle(self):
+        rule = SwitchRule(1, 'myswitch', active=True, site_ids=[2])
+        copy = pickle.loads(pickle.dumps(rule, pickle.HIGHEST_PROTOCOL))
+        for attr in SwitchRule.__slots__:
+            self.assertEqual(getattr(rule, attr), getattr(copy, attr))
+
+
+class SampleRuleTests(TestCase):
+    def test_from_sample(self):
+        rule = SampleRule.from_sample(
+            Sample.objects.create(name='mysample', percent='33.3'))
+        self.assertEqual(333, rule.percent)
+        assert rule.site_ids is None
+
+    def test_immutable(self):
+        rule = SampleRule(1, 'mysample')
+        with self.assertRaises(AttributeError):
+            rule.percent = 1000
@@ -1,9 +1,19 @@
-from django.db import connection
+from django.db import connection, transaction
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import AnonymousUser, Group, User
+from django.test.utils import override_settings
+
+import mock
 
 import waffle
-from waffle.models import Flag, Sample, Switch
+from waffle.compat import cache
+from waffle.models import (FLAG_KEYS, Flag, Sample, Switch, _table_key,
+                           cache_keys, get_all_sites, get_object_versions,
+                           load_flags, load_snapshot, table_version_key,
+                           uncache_switch)
+from waffle.rules import PER_SITE
+from waffle.local import bump, bump_generation, get_versions
+from waffle.sites import site_registry, sites_version_key
 from waffle.tests.base import TestCase
 
 from test_app import views
@@ -78,6 +88,15 @@ class SiteTests(TestCase):
         with self.settings(SITE_ID=2):
             self.assertTrue(waffle.switch_is_active(get(), name))
 
+    @override_settings(WAFFLE_SWITCH_DEFAULT=True)
+    def test_switch_off_site_with_default(self):
+        Switch.objects.create(name='myswitch', active=True, site=self.site1,
+                              all_sites_override=False)
+        self.assertTrue(waffle.switch_is_active(get(), 'myswitch'))
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.switch_is_active(get(), 'myswitch'))
+            self.assertTrue(waffle.switch_is_active(get(), 'unknown'))
+
     def test_get_switches_for_site(self):
         self.assertTrue(len(Switch.get_switches_for_site(self.site1)) == 0)
         name1 = "foo"
@@ -128,6 +147,15 @@ class SiteTests(TestCase):
         with self.settings(SITE_ID=2):
             self.assertTrue(waffle.sample_is_active(get(), name))
     
+    @override_settings(WAFFLE_SAMPLE_DEFAULT=True)
+    def test_sample_off_site_with_default(self):
+        Sample.objects.create(name='sample', percent='100.0', site=self.site1,
+                              all_sites_override=False)
+        self.assertTrue(waffle.sample_is_active(get(), 'sample'))
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.sample_is_active(get(), 'sample'))
+            self.assertTrue(waffle.sample_is_active(get(), 'unknown'))
+
     def test_get_samples_for_site(self):
         self.assertTrue(len(Sample.get_samples_for_site(self.site1)) == 0)
         name1 = "foo"
@@ -155,6 +183,34 @@ class SiteTests(TestCase):
             response = process_request(request, views.flag_in_view)
             self.assertContains(response, b'off')
 
+    def test_flag_site_removed(self):
+        flag = Flag.objects.create(name='myflag', everyone=True,
+                                   site=self.site1, all_sites_override=False)
+        flag.site.add(self.site2)
+        with self.settings(SITE_ID=2):
+            self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+        flag.site.remove(self.site2)
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+
+    def test_flag_site_added_from_site(self):
+        flag = Flag.objects.create(name='myflag', everyone=True,
+                                   site=self.site2, all_sites_override=False)
+        self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        self.site1.waffle_flags_m2m.add(flag)
+        self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+        self.site1.waffle_flags_m2m.clear()
+        self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+
+    def test_switch_site_added_from_site(self):
+        switch = Switch.objects.create(name='myswitch', active=True,
+                                       site=self.site2,
+                                       all_sites_override=False)
+        self.assertFalse(waffle.switch_is_active(get(), 'myswitch'))
+        self.site1.waffle_switches_m2m.add(switch)
+        self.assertTrue(waffle.switch_is_active(get(), 'myswitch'))
+
     def test_flag_all_sites_override(self):
         name = 'sample'
         Flag.objects.create(name=name, everyone=True, site=self.site1)
@@ -177,3 +233,230 @@ class SiteTests(TestCase):
         Flag.objects.create(name=name2,  everyone=True, site=self.site2, all_sites_override=False)
         self.assertEqual({name1, name2}, set([f.name for f in Flag.get_flags_for_site(self.site2)]))
         self.assertEqual([name1], [f.name for f in Flag.get_flags_for_site(self.site1)])
+
+    def test_all_sites_flag_cached_once(self):
+        """Flags on all sites are cached without a site."""
+        Flag.objects.create(name='myflag', everyone=True)
+        self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+
+        version = get_object_versions(FLAG_KEYS, ['myflag'])['myflag']
+        key = cache_keys(FLAG_KEYS, 'myflag', version)[0]
+        self.assertEqual('myflag', cache.get(key).name)
+        self.assertIsNone(cache.get(
+            cache_keys(FLAG_KEYS, 'myflag', version, self.site1)[0]))
+
+        with self.settings(SITE_ID=2):
+            with self.assertNumQueries(1):  # The current site.
+                self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+
+    def test_site_specific_flag_cached_per_site(self):
+        Flag.objects.create(name='myflag', everyone=True, site=self.site2,
+                            all_sites_override=False)
+        self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        version = get_object_versions(FLAG_KEYS, ['myflag'])['myflag']
+        self.assertEqual(PER_SITE, cache.get(
+            cache_keys(FLAG_KEYS, 'myflag', version)[0]))
+
+        with self.settings(SITE_ID=2):
+            self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+            self.assertTrue(waffle.flags_are_active(get(), ['myflag'])['myflag'])
+
+    def test_site_specific_switch_uncached(self):
+        switch = Switch.objects.create(name='myswitch', active=True,
+                                       site=self.site1,
+                                       all_sites_override=False)
+        self.assertTrue(waffle.switch_is_active(get(), 'myswitch'))
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.switch_is_active(get(), 'myswitch'))
+
+        switch.active = False
+        switch.save()
+        self.assertFalse(waffle.switch_is_active(get(), 'myswitch'))
+
+        switch.all_sites_override = True
+        switch.active = True
+        switch.save()
+        with self.settings(SITE_ID=2):
+            self.assertTrue(waffle.switch_is_active(get(), 'myswitch'))
+            self.assertTrue(waffle.switches_are_active(
+                get(), ['myswitch'])['myswitch'])
+
+    def test_uncache_is_constant(self):
+        """Invalidating doesn't touch one key per site."""
+        switch = Switch.objects.create(name='myswitch', active=True,
+                                       site=self.site1,
+                                       all_sites_override=False)
+        switch.site.add(self.site2, self.site3)
+        for site_id in (1, 2, 3):
+            with self.settings(SITE_ID=site_id):
+                waffle.switch_is_active(get(), 'myswitch')
+        key = table_version_key('SWITCH_TABLE_CACHE_KEY')
+        version = get_versions([key])[key]
+
+        with mock.patch.object(cache, 'delete_many') as delete_many:
+            with self.assertNumQueries(0):
+                uncache_switch(instance=switch)
+        # Just the list of all switches.
+        self.assertEqual([1], [len(args[0]) for args, kwargs
+                                in delete_many.call_args_list])
+        self.assertEqual(version + 1, get_versions([key])[key])
+
+    def test_stale_entries_not_read(self):
+        switch = Switch.objects.create(name='myswitch', active=True)
+        self.assertTrue(waffle.switch_is_active(get(), 'myswitch'))
+        key = table_version_key('SWITCH_TABLE_CACHE_KEY')
+        old = _table_key('SWITCH_TABLE_CACHE_KEY', self.site1,
+                         get_versions([key])[key])
+
+        Switch.objects.filter(pk=switch.pk).update(active=False)
+        uncache_switch(instance=switch)
+        # A reader that loaded the old rows can still write them back...
+        cache.set(old, {'myswitch': True})
+        # ...but nobody reads it any more.
+        self.assertFalse(waffle.switch_is_active(get(), 'myswitch'))
+
+    def test_shared_flag_name(self):
+        """Flags sharing a name resolve to the one on the current site."""
+        Flag.objects.create(name='myflag', everyone=False, site=self.site1,
+                            all_sites_override=False)
+        Flag.objects.create(name='myflag', everyone=True, site=self.site2,
+                            all_sites_override=False)
+        self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        with self.settings(SITE_ID=2):
+            self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+            self.assertTrue(
+                waffle.flags_are_active(get(), ['myflag'])['myflag'])
+        with self.settings(SITE_ID=3):
+            self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+
+    def test_site_flag_beats_all_sites_flag(self):
+        Flag.objects.create(name='myflag', everyone=True)
+        Flag.objects.create(name='myflag', everyone=False, site=self.site2,
+                            all_sites_override=False)
+        self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.flag_is_active(get(), 'myflag'))
+        with self.settings(SITE_ID=3):
+            self.assertTrue(waffle.flag_is_active(get(), 'myflag'))
+
+        self.assertTrue(load_snapshot(self.site1).flags['myflag'][0].everyone)
+        self.assertFalse(
+            load_snapshot(self.site2).flags['myflag'][0].everyone)
+
+    def test_shared_switch_and_sample_names(self):
+        Switch.objects.create(name='shared', active=True)
+        Switch.objects.create(name='shared', active=False, site=self.site2,
+                              all_sites_override=False)
+        Sample.objects.create(name='shared', percent='100.0')
+        Sample.objects.create(name='shared', percent='0.0', site=self.site2,
+                              all_sites_override=False)
+        self.assertTrue(waffle.switch_is_active(get(), 'shared'))
+        self.assertTrue(waffle.sample_is_active(get(), 'shared'))
+        with self.settings(SITE_ID=2):
+            self.assertFalse(waffle.switch_is_active(get(), 'shared'))
+            self.assertFalse(waffle.sample_is_active(get(), 'shared'))
+
+    def test_shared_name_load(self):
+        Flag.objects.create(name='myflag', everyone=True)
+        Flag.objects.create(name='myflag', everyone=False, site=self.site2,
+                            all_sites_override=False)
+        Flag.objects.create(name='other', everyone=True)
+        with self.assertNumQueries(4):
+            loaded = load_flags(['myflag', 'other'], self.site2)
+        self.assertFalse(loaded['myflag'][0].everyone)
+        self.assertEqual(set(['myflag']), loaded.per_site)
+        # Without a site, only what doesn't depend on one.
+        self.assertEqual(['other'], list(load_flags(['myflag', 'other'])))
+
+    def test_for_site_without_join(self):
+        flag = Flag.objects.create(name='myflag', site=self.site1,
+                                   all_sites_override=False)
+        flag.site.add(self.site2)
+        Flag.objects.create(name='everywhere')
+        Flag.objects.create(name='elsewhere', site=self.site3,
+                            all_sites_override=False)
+        flags = Flag.get_flags_for_site(self.site1)
+        self.assertEqual(['myflag', 'everywhere'],
+                         [f.name for f in flags.order_by('pk')])
+        sql = str(flags.query).upper()
+        assert 'JOIN' not in sql
+        assert 'DISTINCT' not in sql
+
+
+class SiteRegistryTests(TestCase):
+    def setUp(self):
+        super(SiteRegistryTests, self).setUp()
+        self.site1 = Site.objects.get_current()
+        self.site2 = Site.objects.create(domain='example2.com')
+
+    def test_loaded_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([self.site1, self.site2], site_registry.all())
+            self.assertEqual([self.site2],
+                             site_registry.get_many([self.site2.pk]))
+            self.assertEqual([self.site1, self.site2], get_all_sites())
+
+    def test_unknown_sites(self):
+        site_registry.all()
+        # Added without signals, as if by another process.
+        Site.objects.bulk_create([Site(domain='example3.com')])
+        site3 = Site.objects.get(domain='example3.com')
+        self.assertEqual([self.site2, site3],
+                         site_registry.get_many([self.site2.pk, site3.pk,
+                                                 99]))
+        self.assertEqual([self.site1, self.site2, site3],
+                         site_registry.all())
+
+    def test_changed_elsewhere(self):
+        site_registry.all()
+        Site.objects.filter(pk=self.site2.pk).update(domain='changed.com')
+        bump(sites_version_key())
+        bump_generation()
+        self.assertEqual('changed.com',
+                         site_registry.get_many([self.site2.pk])[0].domain)
+
+    def test_refreshed_on_change(self):
+        site_registry.all()
+        site3 = Site.objects.create(domain='example3.com')
+        self.assertEqual([self.site1, self.site2, site3],
+                         site_registry.all())
+        self.site2.delete()
+        self.assertEqual([self.site1, site3], site_registry.all())
+
+    def test_refreshed_after_commit(self):
+        site_registry.all()
+        callbacks = []
+        with mock.patch.object(transaction, 'on_commit', create=True,
+                               side_effect=lambda f, using=None:
+                               callbacks.append(f)):
+            with transaction.atomic():
+                self.site2.domain = 'changed.com'
+                self.site2.save()
+                # Other threads keep what was committed meanwhile.
+                self.assertEqual('example2.com',
+                                 site_registry.get_many(
+                                     [self.site2.pk])[0].domain)
+        for callback in callbacks:
+            callback()
+        self.assertEqual('changed.com',
+                         site_registry.get_many([self.site2.pk])[0].domain)
+
+    def test_too_many_sites(self):
+        with self.settings(WAFFLE_SITE_REGISTRY_SIZE=1):
+            # One query to find there are too many, then one per lookup.
+            with self.assertNumQueries(3):
+                site_registry.all()
+                site_registry.all()
+            self.assertEqual([self.site2],
+                             site_registry.get_many([self.site2.pk]))
+
+    def test_get_sites(self):
+        switch = Switch.objects.create(name='myswitch', site=self.site2,
+                                       all_sites_override=False)
+        site_registry.all()
+        with self.assertNumQueries(1):
+            self.assertEqual([self.site2], switch.get_sites())
+        switch.all_sites_override = True
+        with self.assertNumQueries(0):
+            self.assertEqual([self.site1, self.site2], switch.get_sites())
@@ -3,7 +3,8 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from waffle import defaults
-from waffle.utils import get_setting
+from waffle.utils import (KeyCache, bucket, get_setting, keyfmt,
+                          waffle_settings)
 
 
 class GetSettingTests(TestCase):
@@ -19,3 +20,58 @@ class GetSettingTests(TestCase):
         assert not get_setting('OVERRIDE')
         with override_settings(WAFFLE_OVERRIDE=True):
             assert get_setting('OVERRIDE')
+
+    def test_resolved_once(self):
+        get_setting('MAX_AGE')
+        self.assertEqual(defaults.MAX_AGE, waffle_settings.__dict__['MAX_AGE'])
+        with override_settings(WAFFLE_MAX_AGE=5):
+            assert 'MAX_AGE' not in waffle_settings.__dict__
+            self.assertEqual(5, waffle_settings.MAX_AGE)
+        self.assertEqual(defaults.MAX_AGE, waffle_settings.MAX_AGE)
+
+    def test_unknown_setting(self):
+        with self.assertRaises(AttributeError):
+            get_setting('NO_SUCH_SETTING')
+
+
+class BucketTests(TestCase):
+    def test_stable(self):
+        self.assertEqual(bucket('foo', 42), bucket('foo', '42'))
+
+    def test_range(self):
+        buckets = [bucket('foo', i) for i in range(1000)]
+        assert all(0 <= b < 1000 for b in buckets)
+        # Roughly uniform.
+        assert 400 < len([b for b in buckets if b < 500]) < 600
+
+    def test_name_matters(self):
+        assert ([bucket('foo', i) for i in range(10)] !=
+                [bucket('bar', i) for i in range(10)])
+
+
+class KeyCacheTests(TestCase):
+    def test_lru(self):
+        keys = KeyCache(2)
+        keys.get('a', str, 'a')
+        keys.get('b', str, 'b')
+        keys.get('a', str, 'x')  # Used, so 'b' goes first.
+        keys.get('c', str, 'c')
+        self.assertEqual('a', keys.get('a', str, 'x'))
+        self.assertEqual('x', keys.get('b', str, 'x'))
+
+    def test_keyfmt_memoized(self):
+        key = keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+        assert key is keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+
+    def test_setting_changed(self):
+        key = keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+        with override_settings(WAFFLE_CACHE_PREFIX='other:'):
+            other = keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+            assert other.startswith(b'other:')
+        self.assertEqual(key, keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo'))
+
+    def test_hash(self):
+        key = keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+        with override_settings(WAFFLE_CACHE_KEY_HASH='sha1'):
+            other = keyfmt(get_setting('FLAG_CACHE_KEY'), 'foo')
+        self.assertEqual(len(key) + 8, len(other))
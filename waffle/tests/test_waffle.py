@@ -1,7 +1,8 @@
 import random
 
 from django.contrib.auth.models import AnonymousUser, Group, User
-from django.db import connection
+from django.contrib.sites.models import Site
+from django.db import connection, transaction
 from django.test import RequestFactory
 from django.test.utils import override_settings
 
@@ -9,9 +10,17 @@ import mock
 
 import waffle
 from test_app import views
+from waffle.compat import cache
+from waffle.utils import bucket
+from waffle.local import LocalCache, get_generation
 from waffle.middleware import WaffleMiddleware
-from waffle.models import Flag, Sample, Switch
+from waffle.models import (FLAG_KEYS, Flag, Sample, Switch, cache_keys,
+                           get_object_versions, get_sample_table,
+                           get_snapshot, get_switch_table, load_snapshot,
+                           lock_key, stale_key)
+from waffle.rules import SampleRule, percent_threshold
 from waffle.tests.base import TestCase
+from waffle.testutils import override_flag
 
 
 def get(**kw):
@@ -128,6 +137,60 @@ class WaffleTests(TestCase):
         self.assertEqual(b'off', response.content)
         assert 'dwf_myflag' not in response.cookies
 
+    def test_user_ids_cached(self):
+        """Targeted users are cached as ids, not User instances."""
+        users = [User.objects.create(username='u%d' % i) for i in range(3)]
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(*users)
+
+        request = get()
+        request.user = users[1]
+        assert waffle.flag_is_active(request, 'myflag')
+
+        version = get_object_versions(FLAG_KEYS, ['myflag'])['myflag']
+        keys = cache_keys(FLAG_KEYS, 'myflag', version)
+        rule = cache.get(keys[0])
+        self.assertEqual(sorted(u.pk for u in users), list(rule.user_ids))
+        # Few enough users to keep in the flag's own entry.
+        self.assertEqual(None, cache.get(keys[1]))
+
+    @override_settings(WAFFLE_FLAG_INLINE_USERS=2)
+    def test_many_user_ids_cached_apart(self):
+        users = [User.objects.create(username='u%d' % i) for i in range(3)]
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(*users)
+
+        request = get()
+        request.user = users[1]
+        assert waffle.flag_is_active(request, 'myflag')
+
+        version = get_object_versions(FLAG_KEYS, ['myflag'])['myflag']
+        keys = cache_keys(FLAG_KEYS, 'myflag', version)
+        rule = cache.get(keys[0])
+        assert rule.has_users
+        self.assertEqual(None, rule.user_ids)
+        self.assertEqual(sorted(u.pk for u in users), list(cache.get(keys[1])))
+
+        # Both are read in the same round trip, without any queries.
+        with mock.patch.object(cache, 'get_many',
+                               wraps=cache.get_many) as get_many:
+            with self.assertNumQueries(0):
+                request = get()
+                request.user = User(pk=users[-1].pk + 1)
+                assert not waffle.flag_is_active(request, 'myflag')
+        # The version of the flag, then its rule and users.
+        self.assertEqual(2, get_many.call_count)
+
+    def test_untargeted_flag_skips_user_lookup(self):
+        Flag.objects.create(name='myflag')
+        waffle.flag_is_active(get(), 'myflag')
+
+        with mock.patch.object(cache, 'get_many',
+                               wraps=cache.get_many) as get_many:
+            assert not waffle.flag_is_active(get(), 'myflag')
+        # The version of the flag, then its rule. Nothing for its users.
+        self.assertEqual(2, get_many.call_count)
+
     def test_group(self):
         """Test the per-group switch."""
         group = Group.objects.create(name='foo')
@@ -149,6 +212,64 @@ class WaffleTests(TestCase):
         self.assertEqual(b'off', response.content)
         assert 'dwf_myflag' not in response.cookies
 
+    def test_user_groups_loaded_once(self):
+        """A user's groups are only queried once for many flags."""
+        group = Group.objects.create(name='foo')
+        user = User.objects.create(username='bar')
+        user.groups.add(group)
+        for name in ('flag1', 'flag2', 'flag3'):
+            flag = Flag.objects.create(name=name)
+            flag.groups.add(Group.objects.create(name=name))
+            waffle.flag_is_active(get(), name)  # Warm the cache.
+
+        request = get()
+        request.user = user
+        with self.assertNumQueries(1):
+            for name in ('flag1', 'flag2', 'flag3'):
+                assert not waffle.flag_is_active(request, name)
+
+    def test_user_groups_changed(self):
+        group = Group.objects.create(name='foo')
+        user = User.objects.create(username='bar')
+        flag = Flag.objects.create(name='myflag')
+        flag.groups.add(group)
+
+        request = get()
+        request.user = user
+        assert not waffle.flag_is_active(request, 'myflag')
+        user.groups.add(group)
+        request = get()
+        request.user = user
+        assert waffle.flag_is_active(request, 'myflag')
+
+    def test_user_added_from_user(self):
+        user = User.objects.create(username='foo')
+        flag = Flag.objects.create(name='myflag')
+        request = get()
+        request.user = user
+        assert not waffle.flag_is_active(request, 'myflag')
+        user.flag_set.add(flag)
+        request = get()
+        request.user = user
+        assert waffle.flag_is_active(request, 'myflag')
+        user.flag_set.clear()
+        request = get()
+        request.user = user
+        assert not waffle.flag_is_active(request, 'myflag')
+
+    def test_group_added_from_group(self):
+        group = Group.objects.create(name='foo')
+        user = User.objects.create(username='bar')
+        user.groups.add(group)
+        flag = Flag.objects.create(name='myflag')
+        request = get()
+        request.user = user
+        assert not waffle.flag_is_active(request, 'myflag')
+        group.flag_set.add(flag)
+        request = get()
+        request.user = user
+        assert waffle.flag_is_active(request, 'myflag')
+
     def test_authenticated(self):
         """Test the authenticated/anonymous switch."""
         Flag.objects.create(name='myflag', authenticated=True)
@@ -204,6 +325,38 @@ class WaffleTests(TestCase):
         response = process_request(request, views.flag_in_view)
         assert 'dwf_myflag' in response.cookies
 
+    @override_settings(WAFFLE_FLAG_BUCKETING=True)
+    def test_bucketing_user(self):
+        """Bucketed flags are decided by the user id, without a cookie."""
+        Flag.objects.create(name='myflag', percent='50.0')
+        users = [User.objects.create(username='u%d' % i) for i in range(20)]
+        results = set()
+        for user in users:
+            request = get()
+            request.user = user
+            response = process_request(request, views.flag_in_view)
+            assert 'dwf_myflag' not in response.cookies
+            on = bucket('myflag', user.pk) < 500
+            self.assertEqual(b'on' if on else b'off', response.content)
+            results.add(on)
+        self.assertEqual(set([True, False]), results)
+
+    @override_settings(WAFFLE_FLAG_BUCKETING=True,
+                       WAFFLE_BUCKETING_ATTRIBUTE='META.REMOTE_ADDR')
+    def test_bucketing_attribute(self):
+        Flag.objects.create(name='myflag', percent='50.0')
+        request = get()
+        on = bucket('myflag', request.META['REMOTE_ADDR']) < 500
+        self.assertEqual(on, waffle.flag_is_active(request, 'myflag'))
+        self.assertEqual(on, waffle.flag_is_active(get(), 'myflag'))
+
+    @override_settings(WAFFLE_FLAG_BUCKETING=True)
+    def test_bucketing_without_key(self):
+        """Without a user or session, fall back to a random cookie."""
+        Flag.objects.create(name='myflag', percent='50.0')
+        response = process_request(get(), views.flag_in_view)
+        assert 'dwf_myflag' in response.cookies
+
     @mock.patch.object(random, 'uniform')
     def test_reroll(self, uniform):
         """Even without a cookie, calling flag_is_active twice should return
@@ -212,15 +365,47 @@ class WaffleTests(TestCase):
         # Make sure we're not really random.
         request = get()  # Create a clean request.
         assert not hasattr(request, 'waffles')
-        uniform.return_value = '10'  # < 50. Flag is True.
+        uniform.return_value = 10  # < 50. Flag is True.
         assert waffle.flag_is_active(request, 'myflag')
         assert hasattr(request, 'waffles')  # We should record this flag.
         assert 'myflag' in request.waffles
         assert request.waffles['myflag'][0]
-        uniform.return_value = '70'  # > 50. Normally, Flag would be False.
+        uniform.return_value = 70  # > 50. Normally, Flag would be False.
         assert waffle.flag_is_active(request, 'myflag')
         assert request.waffles['myflag'][0]
 
+    def test_flag_memoized_for_request(self):
+        """Checking a flag twice in one request only resolves it once."""
+        Flag.objects.create(name='myflag', everyone=True)
+        request = get()
+        assert waffle.flag_is_active(request, 'myflag')
+
+        with mock.patch.object(cache, 'get') as cache_get:
+            with self.assertNumQueries(0):
+                assert waffle.flag_is_active(request, 'myflag')
+        assert not cache_get.called
+
+    def test_flag_memo_follows_user(self):
+        """Swapping the user on a request re-evaluates the flag."""
+        user = User.objects.create(username='foo')
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(user)
+
+        request = get()
+        assert not waffle.flag_is_active(request, 'myflag')
+        request.user = user
+        assert waffle.flag_is_active(request, 'myflag')
+
+    def test_set_flag_overrides_memo(self):
+        Flag.objects.create(name='myflag', percent='50.0')
+        request = get()
+        waffle.flag_is_active(request, 'myflag')
+
+        waffle.set_flag(request, 'myflag', True)
+        assert waffle.flag_is_active(request, 'myflag')
+        waffle.set_flag(request, 'myflag', False)
+        assert not waffle.flag_is_active(request, 'myflag')
+
     def test_undefined(self):
         """Undefined flags are always false."""
         request = get()
@@ -232,6 +417,25 @@ class WaffleTests(TestCase):
         request = get()
         assert waffle.flag_is_active(request, 'foo')
 
+    def test_undefined_cached(self):
+        """Undefined flags are only looked up once."""
+        Site.objects.get_current()
+        with self.assertNumQueries(1):
+            assert not waffle.flag_is_active(get(), 'foo')
+        with self.assertNumQueries(0):
+            assert not waffle.flag_is_active(get(), 'foo')
+            self.assertEqual({'foo': False},
+                             waffle.flags_are_active(get(), ['foo']))
+
+        Flag.objects.create(name='foo', everyone=True)
+        assert waffle.flag_is_active(get(), 'foo')
+
+    def test_undefined_cached_in_batch(self):
+        Site.objects.get_current()
+        waffle.flags_are_active(get(), ['foo'])
+        with self.assertNumQueries(0):
+            assert not waffle.flag_is_active(get(), 'foo')
+
     @override_settings(WAFFLE_OVERRIDE=True)
     def test_override(self):
         request = get(foo='1')
@@ -280,6 +484,369 @@ class WaffleTests(TestCase):
         self.assertEqual(b'on', response.content)
 
 
+class BatchTests(TestCase):
+    def test_flags_are_active(self):
+        Flag.objects.create(name='on', everyone=True)
+        Flag.objects.create(name='off', everyone=False)
+        user = User.objects.create(username='foo')
+        Flag.objects.create(name='user').users.add(user)
+        waffle.flag_is_active(get(), 'on')  # Cache one of them.
+
+        request = get()
+        request.user = user
+        self.assertEqual({'on': True, 'off': False, 'user': True,
+                          'missing': False},
+                         waffle.flags_are_active(
+                             request, ['on', 'off', 'user', 'missing']))
+
+    @override_settings(WAFFLE_FLAG_DEFAULT=True)
+    def test_flags_default(self):
+        self.assertEqual({'missing': True},
+                         waffle.flags_are_active(get(), ['missing']))
+
+    def test_flags_one_round_trip(self):
+        names = ['flag%d' % i for i in range(5)]
+        for name in names:
+            Flag.objects.create(name=name, everyone=True)
+        Site.objects.get_current()
+
+        # Flags, users and groups. They're on all sites, so no site query.
+        with self.assertNumQueries(3):
+            waffle.flags_are_active(get(), names)
+
+        with mock.patch.object(cache, 'get_many',
+                               wraps=cache.get_many) as get_many:
+            with self.assertNumQueries(0):
+                values = waffle.flags_are_active(get(), names)
+        # The versions of the flags, then the flags themselves.
+        self.assertEqual(2, get_many.call_count)
+        assert all(values.values())
+
+    def test_flags_fill_request_memo(self):
+        Flag.objects.create(name='myflag', everyone=True)
+        request = get()
+        waffle.flags_are_active(request, ['myflag'])
+        with mock.patch.object(cache, 'get') as cache_get:
+            assert waffle.flag_is_active(request, 'myflag')
+        assert not cache_get.called
+
+    def test_switches_are_active(self):
+        Switch.objects.create(name='on', active=True)
+        Switch.objects.create(name='off', active=False)
+        Site.objects.get_current()
+        with self.assertNumQueries(1):
+            values = waffle.switches_are_active(get(), ['on', 'off', 'foo'])
+        self.assertEqual({'on': True, 'off': False, 'foo': False}, values)
+        with self.assertNumQueries(0):
+            values = waffle.switches_are_active(get(), ['on', 'off'])
+        self.assertEqual({'on': True, 'off': False}, values)
+
+    def test_samples_are_active(self):
+        Sample.objects.create(name='on', percent='100.0')
+        Sample.objects.create(name='off', percent='0.0')
+        self.assertEqual({'on': True, 'off': False, 'foo': False},
+                         waffle.samples_are_active(get(),
+                                                   ['on', 'off', 'foo']))
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.site = Site.objects.get_current()
+        self.other = Site.objects.create(domain='example2.com')
+
+    def test_load_snapshot(self):
+        user = User.objects.create(username='foo')
+        group = Group.objects.create(name='foo')
+        for i in range(3):
+            flag = Flag.objects.create(name='flag%d' % i)
+            flag.users.add(user)
+            flag.groups.add(group)
+            Switch.objects.create(name='switch%d' % i, active=True)
+            Sample.objects.create(name='sample%d' % i, percent='50.0')
+        Flag.objects.create(name='elsewhere', site=self.other,
+                            all_sites_override=False)
+        Switch.objects.create(name='here', active=True, site=self.site,
+                              all_sites_override=False)
+
+        # Sites are only loaded for objects that aren't on all sites.
+        with self.assertNumQueries(4):
+            snapshot = load_snapshot(self.site)
+        self.assertEqual(set(['flag0', 'flag1', 'flag2', 'elsewhere']),
+                         set(snapshot.flags))
+        assert not snapshot.flags['elsewhere'][0].on_site(self.site)
+        rule, users = snapshot.flags['flag0']
+        assert user.pk in rule.user_ids
+        assert group.pk in rule.group_ids
+        self.assertEqual(None, users)
+
+        assert 'elsewhere' in load_snapshot(self.other).flags
+
+    def use_local_cache(self):
+        """Put a LocalCache everywhere waffle imported the cache from."""
+        local_cache = LocalCache(cache, 60)
+        for target in ('waffle.compat.cache', 'waffle.models.cache',
+                       'waffle.views.cache'):
+            patch = mock.patch(target, local_cache)
+            patch.start()
+            self.addCleanup(patch.stop)
+        return local_cache
+
+    def test_checks_read_snapshot(self):
+        Flag.objects.create(name='myflag', everyone=True)
+        Switch.objects.create(name='myswitch', active=True)
+        Sample.objects.create(name='mysample', percent='100.0')
+        local_cache = self.use_local_cache()
+
+        assert waffle.flag_is_active(get(), 'myflag')
+        assert waffle.switch_is_active(get(), 'myswitch')
+        assert waffle.sample_is_active(get(), 'mysample')
+        with self.assertNumQueries(0):
+            with mock.patch.object(local_cache.cache, 'get') as get_:
+                with mock.patch.object(local_cache.cache,
+                                       'get_many') as get_many:
+                    assert waffle.switch_is_active(get(), 'myswitch')
+                    assert waffle.sample_is_active(get(), 'mysample')
+                    assert not waffle.flag_is_active(get(), 'unknown')
+                    self.assertEqual({'myflag': True, 'unknown': False},
+                                     waffle.flags_are_active(
+                                         get(), ['myflag', 'unknown']))
+        # Everything came from the local copy.
+        self.assertFalse(get_.called or get_many.called)
+
+        Switch.objects.filter(name='myswitch').update(active=False)
+        Switch.objects.get(name='myswitch').save()
+        assert not waffle.switch_is_active(get(), 'myswitch')
+
+    @override_settings(WAFFLE_FLAG_DEFAULT=True)
+    def test_snapshot_flag_off_site(self):
+        Flag.objects.create(name='myflag', everyone=True, site=self.other,
+                            all_sites_override=False)
+        self.use_local_cache()
+
+        assert not waffle.flag_is_active(get(), 'myflag')
+        self.assertEqual({'myflag': False},
+                         waffle.flags_are_active(get(), ['myflag']))
+
+
+class StampedeTests(TestCase):
+    def setUp(self):
+        super(StampedeTests, self).setUp()
+        self.site = Site.objects.get_current()
+        self.flag = Flag.objects.create(name='myflag', everyone=True)
+        assert waffle.flag_is_active(get(), 'myflag')
+        Flag.objects.filter(pk=self.flag.pk).update(everyone=False)
+        self.flag.everyone = False
+        self.flag.save()  # Retires the cached flag.
+
+    def lock(self):
+        version = get_object_versions(FLAG_KEYS, ['myflag'])['myflag']
+        return lock_key('flag:myflag@%s' % version)
+
+    def test_stale_while_locked(self):
+        lock = self.lock()
+        cache.add(lock, 1)
+        with self.assertNumQueries(0):
+            assert waffle.flag_is_active(get(), 'myflag')
+        cache.delete(lock)
+        assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_no_stale_copy(self):
+        cache.delete(stale_key('flag:myflag:%d' % self.site.pk))
+        cache.add(self.lock(), 1)
+        assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_lock_released(self):
+        assert not waffle.flag_is_active(get(), 'myflag')
+        assert cache.add(self.lock(), 1)
+
+    def test_no_stale_keys_when_cached(self):
+        assert not waffle.flag_is_active(get(), 'myflag')
+        with mock.patch('waffle.models.object_stale_key') as stale:
+            assert not waffle.flag_is_active(get(), 'myflag')
+        self.assertEqual(0, stale.call_count)
+
+    def test_early_refresh(self):
+        assert not waffle.flag_is_active(get(), 'myflag')
+        key = stale_key('flag:myflag:%d' % self.site.pk)
+        copy = cache.get(key)
+        cache.set(key, (0, copy[1], copy[2]))
+        with self.assertNumQueries(0):
+            waffle.flag_is_active(get(), 'myflag')
+        with override_settings(WAFFLE_CACHE_EARLY_REFRESH=1):
+            with self.assertNumQueries(3):
+                assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_snapshot_stale_while_locked(self):
+        snapshot = get_snapshot(self.site)
+        Flag.objects.create(name='other', everyone=True)
+        cache.add(lock_key('snapshot:%s@%s' % (
+            self.site.pk, get_generation())), 1)
+        self.assertEqual(set(snapshot.flags),
+                         set(get_snapshot(self.site).flags))
+        assert 'other' not in get_snapshot(self.site).flags
+
+    def test_lock_released_on_error(self):
+        with mock.patch('waffle.models.load_flags',
+                        side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                waffle.flag_is_active(get(), 'unknown')
+        version = get_object_versions(FLAG_KEYS, ['unknown'])['unknown']
+        assert cache.add(lock_key('flag:unknown@%s' % version), 1)
+
+    def test_snapshot_lock_released_on_error(self):
+        lock = lock_key('snapshot:%s@%s' % (self.site.pk, get_generation()))
+        with mock.patch('waffle.models.load_snapshot',
+                        side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                get_snapshot(self.site)
+        assert cache.add(lock, 1)
+
+    def test_snapshot_lock_kept(self):
+        lock = lock_key('snapshot:%s@%s' % (self.site.pk, get_generation()))
+        cache.delete(stale_key('snapshot:%s' % self.site.pk))
+        cache.add(lock, 1)
+        assert 'myflag' in get_snapshot(self.site).flags
+        assert not cache.add(lock, 1)
+
+
+@override_settings(WAFFLE_WRITE_THROUGH=True)
+class WriteThroughTests(TestCase):
+    def setUp(self):
+        super(WriteThroughTests, self).setUp()
+        Site.objects.get_current()
+
+    def test_save(self):
+        flag = Flag.objects.create(name='myflag', everyone=True)
+        with self.assertNumQueries(0):
+            assert waffle.flag_is_active(get(), 'myflag')
+        flag.everyone = False
+        flag.save()
+        with self.assertNumQueries(0):
+            assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_m2m(self):
+        user = User.objects.create(username='foo')
+        flag = Flag.objects.create(name='myflag')
+        flag.users.add(user)
+        request = get()
+        request.user = user
+        with self.assertNumQueries(0):
+            assert waffle.flag_is_active(request, 'myflag')
+
+    def test_delete(self):
+        flag = Flag.objects.create(name='myflag', everyone=True)
+        flag.delete()
+        with self.assertNumQueries(0):
+            assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_switch(self):
+        switch = Switch.objects.create(name='myswitch', active=True)
+        with self.assertNumQueries(0):
+            assert waffle.switch_is_active(get(), 'myswitch')
+        switch.active = False
+        switch.save()
+        with self.assertNumQueries(0):
+            assert not waffle.switch_is_active(get(), 'myswitch')
+
+    def test_sample(self):
+        sample = Sample.objects.create(name='mysample', percent='100.0')
+        with self.assertNumQueries(0):
+            assert waffle.sample_is_active(get(), 'mysample')
+        sample.delete()
+        with self.assertNumQueries(0):
+            assert not waffle.sample_is_active(get(), 'mysample')
+
+
+class OnCommitTests(TestCase):
+    """Invalidations wait for the transaction to commit."""
+
+    def setUp(self):
+        super(OnCommitTests, self).setUp()
+        self.callbacks = []
+        patches = [
+            mock.patch.object(transaction, 'on_commit', create=True,
+                              side_effect=self.on_commit),
+            mock.patch.object(connection, 'run_on_commit', [], create=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def on_commit(self, func, using=None):
+        connection.run_on_commit.append((set(), func))
+        self.callbacks.append(func)
+
+    def commit(self):
+        connection.run_on_commit = []
+        for func in self.callbacks:
+            func()
+        self.callbacks = []
+
+    def test_coalesced(self):
+        user = User.objects.create(username='foo')
+        with mock.patch('waffle.models.bump_generation') as bump_generation:
+            with transaction.atomic():
+                flag = Flag.objects.create(name='myflag')
+                flag.users.add(user)
+                flag.everyone = True
+                flag.save()
+                Switch.objects.create(name='myswitch')
+                Switch.objects.create(name='other')
+        # Once for the flag and once for the switch table, right away.
+        self.assertEqual(2, bump_generation.call_count)
+        self.assertEqual(1, len(self.callbacks))
+
+        with mock.patch('waffle.models.bump_generation') as bump_generation:
+            self.commit()
+        self.assertEqual(1, bump_generation.call_count)
+
+    def test_deferred(self):
+        switch = Switch.objects.create(name='myswitch', active=True)
+        assert waffle.switch_is_active(get(), 'myswitch')
+        with transaction.atomic():
+            switch.active = False
+            switch.save()
+            # The transaction sees its own changes.
+            assert not waffle.switch_is_active(get(), 'myswitch')
+        # Others may have cached the old switch before the commit.
+        with mock.patch('waffle.models.bump_generation') as bump_generation:
+            self.commit()
+        self.assertEqual(1, bump_generation.call_count)
+        assert not waffle.switch_is_active(get(), 'myswitch')
+
+    def test_uncommitted_not_cached(self):
+        flag = Flag.objects.create(name='myflag', everyone=True)
+        self.commit()
+        assert waffle.flag_is_active(get(), 'myflag')
+        with transaction.atomic():
+            flag.everyone = False
+            flag.save()
+            with mock.patch.object(cache, 'set_many') as set_many:
+                with mock.patch.object(cache, 'add') as add:
+                    assert not waffle.flag_is_active(get(), 'myflag')
+                    assert not waffle.flag_is_active(get(), 'myflag')
+        self.assertFalse(set_many.called or add.called)
+        self.commit()
+        assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_override_flag(self):
+        Flag.objects.create(name='myflag', everyone=False)
+        assert not waffle.flag_is_active(get(), 'myflag')
+        with transaction.atomic():
+            with override_flag('myflag', active=True):
+                assert waffle.flag_is_active(get(), 'myflag')
+            assert not waffle.flag_is_active(get(), 'myflag')
+
+    def test_new_transaction(self):
+        with transaction.atomic():
+            Switch.objects.create(name='myswitch', active=True)
+        self.commit()
+        with transaction.atomic():
+            Switch.objects.create(name='other', active=True)
+        self.assertEqual(1, len(self.callbacks))
+
+
 class SwitchTests(TestCase):
     def test_switch_active(self):
         switch = Switch.objects.create(name='myswitch', active=True)
@@ -307,6 +874,15 @@ class SwitchTests(TestCase):
         assert not waffle.switch_is_active(get(), switch.name)
         self.assertEqual(queries, len(connection.queries), 'We should only make one query.')
 
+    def test_switch_memoized_for_request(self):
+        switch = Switch.objects.create(name='myswitch', active=True)
+        request = get()
+        assert waffle.switch_is_active(request, switch.name)
+
+        with mock.patch.object(cache, 'get') as cache_get:
+            assert waffle.switch_is_active(request, switch.name)
+        assert not cache_get.called
+
     def test_undefined(self):
         assert not waffle.switch_is_active(get(), 'foo')
 
@@ -314,8 +890,125 @@ class SwitchTests(TestCase):
     def test_undefined_default(self):
         assert waffle.switch_is_active(get(), 'foo')
 
+    def test_undefined_cached(self):
+        Site.objects.get_current()
+        with self.assertNumQueries(1):
+            assert not waffle.switch_is_active(get(), 'foo')
+        with self.assertNumQueries(0):
+            assert not waffle.switch_is_active(get(), 'foo')
+
+        Switch.objects.create(name='foo', active=True)
+        assert waffle.switch_is_active(get(), 'foo')
+
+    def test_one_fetch_per_request(self):
+        for i in range(50):
+            Switch.objects.create(name='switch%d' % i, active=i % 2 == 0)
+        names = ['switch%d' % i for i in range(50)]
+        waffle.switch_is_active(get(), 'switch0')
+
+        request = get()
+        with mock.patch('waffle.models.get_switch_table',
+                        wraps=get_switch_table) as fetch:
+            with self.assertNumQueries(0):
+                for i, name in enumerate(names):
+                    self.assertEqual(i % 2 == 0,
+                                     waffle.switch_is_active(request, name))
+                self.assertEqual(
+                    dict((name, i % 2 == 0) for i, name in enumerate(names)),
+                    waffle.switches_are_active(request, names))
+        self.assertEqual(1, fetch.call_count)
+
+    def test_table_rebuilt_on_site_change(self):
+        site = Site.objects.get_current()
+        other = Site.objects.create(domain='example2.com')
+        switch = Switch.objects.create(name='myswitch', active=True,
+                                       site=other, all_sites_override=False)
+        assert not waffle.switch_is_active(get(), 'myswitch')
+
+        switch.site.add(site)
+        assert waffle.switch_is_active(get(), 'myswitch')
+
+        # Changes that bypass the signals of switches are picked up when a
+        # site changes.
+        Switch.site.through.objects.filter(site=site).delete()
+        site.save()
+        assert not waffle.switch_is_active(get(), 'myswitch')
+
 
 class SampleTests(TestCase):
+    def test_sample_threshold(self):
+        Sample.objects.create(name='sample', percent='12.5')
+        with mock.patch('waffle._random') as _random:
+            _random.return_value = lambda: 0.1249
+            assert waffle.sample_is_active(get(), 'sample')
+            _random.return_value = lambda: 0.125
+            assert not waffle.sample_is_active(get(), 'sample')
+
+    def test_keyed(self):
+        Sample.objects.create(name='sample', percent='50.0')
+        keys = ['trace%d' % i for i in range(50)]
+        expected = [bucket('sample', k) < 500 for k in keys]
+        assert any(expected) and not all(expected)
+        request = get()
+        for key, active in zip(keys, expected):
+            self.assertEqual(active,
+                             waffle.sample_is_active(request, 'sample', key))
+            self.assertEqual(active,
+                             waffle.sample_is_active(get(), 'sample', key=key))
+        self.assertEqual({'sample': expected[0]},
+                         waffle.samples_are_active(get(), ['sample'],
+                                                   key=keys[0]))
+
+    def test_keyed_probe(self):
+        sample = Sample(name='sample', percent='50.0')
+        self.assertEqual(bucket('sample', 'trace') < 500,
+                         waffle.probe_a_sample(sample, key='trace'))
+
+    def test_probe_rule(self):
+        sample = Sample(name='sample', percent='50.0')
+        rule = SampleRule.from_sample(sample, site_ids=[])
+        self.assertEqual(waffle.probe_a_sample(sample, key='trace'),
+                         waffle.probe_a_sample(rule, key='trace'))
+        assert waffle.probe_a_sample(SampleRule(None, 'on', percent=1000))
+        assert not waffle.probe_a_sample(SampleRule(None, 'off'))
+
+    def test_probe_converts_once(self):
+        sample = Sample(name='sample', percent='100.0')
+        with mock.patch('waffle.percent_threshold',
+                        wraps=percent_threshold) as convert:
+            for i in range(10):
+                assert waffle.probe_a_sample(sample)
+            sample.percent = '0.0'
+            assert not waffle.probe_a_sample(sample)
+        self.assertEqual(2, convert.call_count)
+
+    def test_one_fetch_per_request(self):
+        for i in range(20):
+            Sample.objects.create(name='sample%d' % i, percent='100.0')
+        names = ['sample%d' % i for i in range(20)]
+        waffle.sample_is_active(get(), 'sample0')
+
+        with mock.patch('waffle.models.get_sample_table',
+                        wraps=get_sample_table) as fetch:
+            with self.assertNumQueries(0):
+                self.assertEqual(dict((name, True) for name in names),
+                                 waffle.samples_are_active(get(), names))
+        self.assertEqual(1, fetch.call_count)
+
+    def test_table_rebuilt_on_change(self):
+        sample = Sample.objects.create(name='sample', percent='100.0')
+        assert waffle.sample_is_active(get(), 'sample')
+        sample.percent = '0.0'
+        sample.save()
+        assert not waffle.sample_is_active(get(), 'sample')
+
+        other = Site.objects.create(domain='example2.com')
+        sample.percent = '100.0'
+        sample.all_sites_override = False
+        sample.save()
+        sample.site.add(other)
+        assert not waffle.sample_is_active(get(), 'sample')
+
     def test_sample_100(self):
         sample = Sample.objects.create(name='sample', percent='100.0')
         assert waffle.sample_is_active(get(), sample.name)
@@ -324,9 +1017,30 @@ class SampleTests(TestCase):
         sample = Sample.objects.create(name='sample', percent='0.0')
         assert not waffle.sample_is_active(get(), sample.name)
 
+    @mock.patch('waffle._random')
+    def test_sample_sticky_for_request(self, _random):
+        Sample.objects.create(name='sample', percent='50.0')
+        request = get()
+        _random.return_value = lambda: 0.1
+        assert waffle.sample_is_active(request, 'sample')
+        _random.return_value = lambda: 0.7
+        assert waffle.sample_is_active(request, 'sample')
+        # A new request gets a new roll.
+        assert not waffle.sample_is_active(get(), 'sample')
+
     def test_undefined(self):
         assert not waffle.sample_is_active(get(), 'foo')
 
     @override_settings(WAFFLE_SAMPLE_DEFAULT=True)
     def test_undefined_default(self):
         assert waffle.sample_is_active(get(), 'foo')
+
+    def test_undefined_cached(self):
+        Site.objects.get_current()
+        with self.assertNumQueries(1):
+            assert not waffle.sample_is_active(get(), 'foo')
+        with self.assertNumQueries(0):
+            assert not waffle.sample_is_active(get(), 'foo')
+
+        Sample.objects.create(name='foo', percent='100.0')
+        assert waffle.sample_is_active(get(), 'foo')
@@ -1,17 +1,98 @@
 from __future__ import unicode_literals, absolute_import
 
+from collections import OrderedDict
 import hashlib
+import threading
 
 from django.conf import settings
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
 
 from . import defaults
 
 
+class WaffleSettings(object):
+    """Waffle's settings, resolved once.
+
+    Each setting is looked up in the Django settings (as ``WAFFLE_<name>``),
+    falling back to :mod:`waffle.defaults`, the first time it's read and
+    then kept as a plain attribute. Everything is forgotten whenever a
+    ``WAFFLE_*`` setting changes.
+    """
+
+    def __getattr__(self, name):
+        # Only called for settings that haven't been resolved yet.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            value = getattr(settings, 'WAFFLE_' + name)
+        except AttributeError:
+            value = getattr(defaults, name)
+        self.__dict__[name] = value
+        return value
+
+    def clear(self):
+        self.__dict__.clear()
+
+
+waffle_settings = WaffleSettings()
+
+
 def get_setting(name):
-    try:
-        return getattr(settings, 'WAFFLE_' + name)
-    except AttributeError:
-        return getattr(defaults, name)
+    return getattr(waffle_settings, name)
+
+
+def bucket(name, key):
+    """Hash a name and a subject key into a stable bucket from 0 to 999."""
+    value = '%s:%s' % (name, key)
+    digest = hashlib.md5(value.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % 1000
+
+
+class KeyCache(object):
+    """A bounded, thread-safe LRU memo of derived cache keys."""
+
+    def __init__(self, size):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, memo_key, build, *args):
+        """Return the key memoized as ``memo_key``, calling
+        ``build(*args)`` to derive it the first time."""
+        keys = self._keys
+        with self._lock:
+            try:
+                key = keys.pop(memo_key)
+            except KeyError:
+                pass
+            else:
+                keys[memo_key] = key
+                return key
+        key = build(*args)
+        with self._lock:
+            keys[memo_key] = key
+            while len(keys) > self.size:
+                keys.popitem(last=False)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+key_cache = KeyCache(get_setting('KEY_CACHE_SIZE'))
+
+
+def _settings_changed(**kwargs):
+    if kwargs['setting'].startswith('WAFFLE_'):
+        waffle_settings.clear()
+        key_cache.size = get_setting('KEY_CACHE_SIZE')
+        key_cache.clear()
+
+setting_changed.connect(_settings_changed, dispatch_uid='waffle_settings')
 
 
 def keyfmt(k, v=None, s=None):
@@ -19,7 +100,15 @@ def keyfmt(k, v=None, s=None):
         k = {}_CACHE_KEY see defaults.py
         v = switch/flag/sample name
         s = site
+
+    Keys are memoized, see :data:`key_cache`.
     """
+    return key_cache.get(('keyfmt', k, v, None if s is None else s.id),
+                         build_key, k, v, s)
+
+
+def build_key(k, v=None, s=None):
+    """Like :func:`keyfmt`, without memoizing the key."""
     prefix = get_setting('CACHE_PREFIX')
     if v is None:
         key = prefix + k
@@ -28,5 +117,7 @@ def keyfmt(k, v=None, s=None):
             site_unique = v
         else:
             site_unique = '%s:%d' % (v, s.id)
-        key = prefix + hashlib.md5((k % site_unique).encode('utf-8')).hexdigest()
+        digest = hashlib.new(get_setting('CACHE_KEY_HASH'),
+                             (k % site_unique).encode('utf-8')).hexdigest()
+        key = prefix + digest
     return key.encode('utf-8')
@@ -2,7 +2,7 @@ from django.http import HttpResponse
 from django.template import loader
 from django.views.decorators.cache import never_cache
 
-from waffle import flag_is_active, sample_is_active
+from waffle import flags_are_active, samples_are_active, switches_are_active
 from waffle.compat import cache
 from waffle.models import Flag, Sample, Switch
 from waffle.utils import get_setting, keyfmt
@@ -19,23 +19,24 @@ def _generate_waffle_js(request):
     if flags is None:
         flags = Flag.objects.values_list('name', flat=True)
         cache.add(keyfmt(get_setting('ALL_FLAGS_CACHE_KEY')), flags)
-    flag_values = [(f, flag_is_active(request, f)) for f in flags]
+    flag_values = flags_are_active(request, flags)
 
     switches = cache.get(keyfmt(get_setting('ALL_SWITCHES_CACHE_KEY')))
     if switches is None:
-        switches = Switch.objects.values_list('name', 'active')
+        switches = Switch.objects.values_list('name', flat=True)
         cache.add(keyfmt(get_setting('ALL_SWITCHES_CACHE_KEY')), switches)
+    switch_values = switches_are_active(request, switches)
 
     samples = cache.get(keyfmt(get_setting('ALL_SAMPLES_CACHE_KEY')))
     if samples is None:
         samples = Sample.objects.values_list('name', flat=True)
         cache.add(keyfmt(get_setting('ALL_SAMPLES_CACHE_KEY')), samples)
-    sample_values = [(s, sample_is_active(request, s)) for s in samples]
+    sample_values = samples_are_active(request, samples)
 
     return loader.render_to_string('waffle/waffle.js', {
-        'flags': flag_values,
-        'switches': switches,
-        'samples': sample_values,
+        'flags': [(f, flag_values[f]) for f in flags],
+        'switches': [(s, switch_values[s]) for s in switches],
+        'samples': [(s, sample_values[s]) for s in samples],
         'flag_default': get_setting('FLAG_DEFAULT'),
         'switch_default': get_setting('SWITCH_DEFAULT'),
         'sample_default': get_setting('SAMPLE_DEFAULT'),